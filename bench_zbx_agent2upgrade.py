@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+
+
+# Author: AcidGo
+# Usage:
+#   python bench_zbx_agent2upgrade.py [--params N] [--includes N] [--ups N] [--repeat N]
+#       [--baseline bench_baseline.json] [--save-baseline] [--tolerance 0.3]
+#   生成合成的 agentd/agent2 配置，在临时目录中对配置处理的热点函数计时并记录内存峰值，
+#   与保存的基线对比，超出容忍度的视为性能回退，退出码为 1。
+#   基线中的耗时是绝对值，只在生成它的机器上有意义；在其他机器上对比前，先在修改前的代码上以
+#   --save-baseline 重新生成。
+
+
+from __future__ import print_function
+import os, sys, time
+import argparse
+import json
+import logging
+import re
+import resource
+import shutil
+import subprocess
+import tempfile
+
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import zbx_agent2upgrade as upgrade
+
+
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+def gen_sandbox(root, params, includes, ups, conflict_every=20):
+    """在 root 下生成合成的配置。
+
+    Args:
+        root: 沙箱目录。
+        params: agentd 和 agent2 配置中普通参数的数量。
+        includes: Include 目录下文件的数量。
+        ups: 每个 Include 文件中 UserParameter 的数量。
+        conflict_every: 每隔多少个 UserParameter 生成一个与内置 key 冲突的。
+    Returns:
+        <dict>: 各文件的路径。
+    """
+    include_dir = os.path.join(root, "zabbix_agentd.d")
+    os.makedirs(include_dir)
+    builtin = upgrade.CONF_CONFLICT_UP
+    n = 0
+    for i in range(includes):
+        with open(os.path.join(include_dir, "up_{:04d}.conf".format(i)), "w") as f:
+            for j in range(ups):
+                n += 1
+                if n % conflict_every == 0:
+                    key = builtin[n % len(builtin)]
+                else:
+                    key = "custom.item{:d}.key{:d}[*]".format(i, j)
+                f.write("UserParameter={!s},/usr/local/bin/check.sh {:d} $1\n".format(key, n))
+
+    agentd_conf = os.path.join(root, "zabbix_agentd.conf")
+    agent2_conf = os.path.join(root, "zabbix_agent2.conf")
+    with open(agentd_conf, "w") as f:
+        f.write("PidFile=/var/run/zabbix/zabbix_agentd.pid\n")
+        f.write("Server=10.0.0.1,10.0.0.2\nHostname=bench\nStartAgents=10\n")
+        for i in range(params):
+            f.write("Param{:d}=agentd-{:d}\n".format(i, i))
+        for i in range(ups):
+            key = builtin[i % len(builtin)] if i % conflict_every == 0 else "main.key{:d}".format(i)
+            f.write("UserParameter={!s},echo {:d}\n".format(key, i))
+        f.write("Include={!s}/*.conf\n".format(include_dir))
+    with open(agent2_conf, "w") as f:
+        f.write("PidFile=/var/run/zabbix/zabbix_agent2.pid\nServer=127.0.0.1\nHostname=Zabbix server\n")
+        for i in range(params):
+            f.write("### Option: Param{:d}\n".format(i))
+            if i % 2:
+                f.write("Param{:d}=agent2-{:d}\n".format(i, i))
+            else:
+                f.write("# Param{:d}=\n".format(i))
+        f.write("### Option: Include\n# Include=\n### Option: UserParameter\n# UserParameter=\n")
+    return {
+        "root": root,
+        "agentd_conf": agentd_conf,
+        "agent2_conf": agent2_conf,
+        "include_dir": include_dir,
+    }
+
+def bench_parse_zbx_conf(sb):
+    upgrade.parse_zbx_conf(sb["agentd_conf"], True)
+
+def bench_check_conflict_up(sb):
+    upgrade.check_conflict_up(sb["agentd_conf"])
+
+def setup_update_diff_conf(sb):
+    diff = upgrade.diff_zbx_conf(
+        upgrade.load_zbx_conf(sb["agentd_conf"]),
+        upgrade.load_zbx_conf(sb["agent2_conf"]),
+        True,
+    )
+    return diff.update_items, diff.add_items
+
+def bench_update_diff_conf(sb, items):
+    upgrade.update_diff_conf(sb["agent2_conf"], items[0], items[1], upgrade.CONF_IGNORE_ITEM)
+
+def bench_conv_agent2_conf(sb):
+    upgrade.conv_agent2_conf(sb["agentd_conf"], sb["agent2_conf"], True, True)
+
+def setup_deal_conflict_up(sb):
+    return upgrade.check_conflict_up(sb["agentd_conf"])[0]
+
+def bench_deal_conflict_up(sb, conflict_dict):
+    upgrade.deal_conflict_up(conflict_dict)
+
+def bench_audit_up(sb):
+    upgrade.audit_up(sb["agentd_conf"])
+
+# (name, setup, bench)，setup 的耗时不计入。
+BENCHMARKS = [
+    ("parse_zbx_conf", None, bench_parse_zbx_conf),
+    ("check_conflict_up", None, bench_check_conflict_up),
+    ("update_diff_conf", setup_update_diff_conf, bench_update_diff_conf),
+    ("conv_agent2_conf", None, bench_conv_agent2_conf),
+    ("deal_conflict_up", setup_deal_conflict_up, bench_deal_conflict_up),
+    ("audit_up", None, bench_audit_up),
+]
+
+def _proc_status_kb(name):
+    with open("/proc/self/status", "r") as f:
+        m = re.search(r"(?m)^{!s}:\s+(\d+)".format(name), f.read())
+    return int(m.group(1))
+
+def _reset_peak_rss():
+    """重置本进程的内存峰值（VmHWM），返回当前的 RSS（KB），内核不支持时返回 None。
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return _proc_status_kb("VmRSS")
+    except (IOError, OSError, AttributeError):
+        return None
+
+def _run_once(args, setup, bench):
+    """在新启动的解释器中运行一次，返回耗时和内存峰值的增量（KB）。
+
+    fork 出的子进程会继承父进程的 ru_maxrss，且导入模块时的峰值通常高于被测函数，
+    因此以 --child 重新执行本脚本，并在计时前重置 VmHWM，增量为 VmHWM 减去重置时的 RSS。
+    不支持重置时退化为 ru_maxrss 减去生成沙箱之前的值。
+    """
+    rss_base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    root = tempfile.mkdtemp(prefix="zbx_agent2upgrade.bench.")
+    try:
+        sb = gen_sandbox(root, args.params, args.includes, args.ups)
+        setup_res = setup(sb) if setup else None
+        upgrade._ZBX_CONF_CACHE.clear()
+        upgrade._UP_SCAN_CACHE.clear()
+        rss_start = _reset_peak_rss()
+        start = time.time()
+        if setup:
+            bench(sb, setup_res)
+        else:
+            bench(sb)
+        duration = time.time() - start
+        if rss_start is not None:
+            rss_peak = _proc_status_kb("VmHWM") - rss_start
+        else:
+            rss_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_base
+        return duration, rss_peak
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+
+def run_benchmark(args, name):
+    durations = []
+    peaks = []
+    cmd = [
+        sys.executable, os.path.abspath(__file__), "--child", name,
+        "--params", str(args.params), "--includes", str(args.includes), "--ups", str(args.ups),
+    ]
+    for _ in range(args.repeat):
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = p.communicate()
+        if p.returncode != 0:
+            raise Exception("benchmark {!s} is failed: {!s}".format(name, stderr.strip()))
+        duration, peak = json.loads(stdout.strip().splitlines()[-1])
+        durations.append(duration)
+        peaks.append(peak)
+    durations.sort()
+    return {
+        "min": round(durations[0], 6),
+        "median": round(durations[len(durations) // 2], 6),
+        "peak_kb": max(peaks),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the config processing of zbx_agent2upgrade")
+    parser.add_argument("--params", type=int, default=200, help="number of plain params")
+    parser.add_argument("--includes", type=int, default=50, help="number of include files")
+    parser.add_argument("--ups", type=int, default=100, help="number of UserParameters per include file")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per benchmark")
+    parser.add_argument("--only", action="append", help="run only the named benchmark")
+    parser.add_argument("--baseline", default=BASELINE_PATH, help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.3, help="allowed slowdown ratio to the baseline")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    if args.child:
+        for name, setup, bench in BENCHMARKS:
+            if name == args.child:
+                print(json.dumps(_run_once(args, setup, bench)))
+                return
+        raise Exception("unknown benchmark: {!s}".format(args.child))
+
+    scale = "params={:d},includes={:d},ups={:d}".format(args.params, args.includes, args.ups)
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f).get(scale, {})
+
+    results = {}
+    regressions = []
+    print("{:<20} {:>10} {:>10} {:>10} {:>10}".format("benchmark", "min(s)", "median(s)", "peak(KB)", "baseline"))
+    for name, setup, bench in BENCHMARKS:
+        if args.only and name not in args.only:
+            continue
+        res = run_benchmark(args, name)
+        results[name] = res
+        base = baseline.get(name)
+        mark = "-"
+        if base:
+            ratio = res["median"] / base["median"] if base["median"] else 1
+            mark = "{:.2f}x".format(ratio)
+            if ratio > 1 + args.tolerance:
+                regressions.append(name)
+                mark += " !"
+        print("{:<20} {:>10.4f} {:>10.4f} {:>10d} {:>10}".format(name, res["min"], res["median"], res["peak_kb"], mark))
+
+    if args.save_baseline:
+        data = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline, "r") as f:
+                data = json.load(f)
+        data.setdefault(scale, {}).update(results)
+        with open(args.baseline, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        print("baseline is saved to {!s}".format(args.baseline))
+
+    if regressions:
+        print("regression: {!s}".format(", ".join(regressions)))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,766 @@
+# -*- coding: utf-8 -*-
+
+
+# Author: AcidGo
+# Usage:
+#   python -m unittest -v test_zbx_agent2upgrade
+#   以临时目录中的配置文件测试配置的对比和改写，网络相关的部分在 127.0.0.1 上启动替身的
+#   Zabbix 被动检查监听和 HTTP 服务。
+
+
+import os, sys, time
+import BaseHTTPServer
+import hashlib
+import json
+import logging
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import unittest
+
+sys.dont_write_bytecode = True
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import zbx_agent2upgrade as upgrade
+
+
+class TempDirTestCase(unittest.TestCase):
+    """每个测试使用独立的临时目录。
+    """
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="zbx_agent2upgrade.test.")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def write(self, name, lines):
+        path = os.path.join(self.tmp, name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "w") as f:
+            f.write("".join(i + "\n" for i in lines))
+        return path
+
+    def read(self, path):
+        with open(path, "r") as f:
+            return f.read()
+
+class TokenizeTest(TempDirTestCase):
+    def test_tokenize(self):
+        tokenize = upgrade.tokenize_zbx_line
+        self.assertEqual(tokenize("Server = 127.0.0.1\n"), ("Server", "127.0.0.1"))
+        self.assertEqual(tokenize("\tHostname=h1 \r\n"), ("Hostname", "h1"))
+        self.assertEqual(tokenize("UserParameter=a[*],echo $1 # x=y"), ("UserParameter", "a[*],echo $1 # x=y"))
+        self.assertEqual(tokenize("Alias=k:v="), ("Alias", "k:v="))
+        self.assertEqual(tokenize("LogFile="), ("LogFile", ""))
+        for line in ("", "   \n", "# Server=127.0.0.1", "  # Timeout=3", "no separator", "=value"):
+            self.assertIsNone(tokenize(line))
+        self.assertRaises(ValueError, tokenize, "no separator", True)
+        self.assertRaises(ValueError, tokenize, " = value", True)
+
+    def test_iter(self):
+        path = self.write("a.conf", ["# Server=1", "Server=127.0.0.1", "", "UserParameter=a,echo a",
+                                     "UserParameter=a,echo b"])
+        self.assertEqual(list(upgrade.iter_zbx_conf(path)), [
+            (2, "Server", "127.0.0.1"),
+            (4, "UserParameter", "a,echo a"),
+            (5, "UserParameter", "a,echo b"),
+        ])
+
+    def test_iter_invalid(self):
+        path = self.write("a.conf", ["Server=127.0.0.1", "garbage"])
+        with self.assertRaises(Exception) as ctx:
+            list(upgrade.iter_zbx_conf(path))
+        self.assertIn("line 2", str(ctx.exception))
+
+class ConfDiffTest(TempDirTestCase):
+    def diff(self, agentd_lines, agent2_lines, ignore_not_support_params=False):
+        return upgrade.diff_zbx_conf(
+            upgrade.load_zbx_conf(self.write("agentd.conf", agentd_lines)),
+            upgrade.load_zbx_conf(self.write("agent2.conf", agent2_lines)),
+            ignore_not_support_params,
+        )
+
+    def test_update_and_add(self):
+        diff = self.diff(
+            ["Server=10.0.0.1", "Hostname=h1", "Timeout=10", "Timeout=20"],
+            ["Server=127.0.0.1", "Hostname=h1"],
+        )
+        self.assertEqual(diff.update_items, [("Server", "10.0.0.1")])
+        # 单值参数以最后一个值为准
+        self.assertEqual(diff.add_items, [("Timeout", "20")])
+        self.assertTrue(diff)
+
+    def test_no_diff(self):
+        diff = self.diff(["Server=127.0.0.1"], ["Server=127.0.0.1", "Hostname=h1"])
+        self.assertFalse(diff)
+        self.assertEqual(diff.to_dict()["update_items"], [])
+
+    def test_multi_value_adds_missing_values(self):
+        diff = self.diff(
+            ["UserParameter=a,echo a", "UserParameter=b,echo b", "UserParameter=a,echo a"],
+            ["UserParameter=b,echo b"],
+        )
+        self.assertEqual(diff.add_items, [("UserParameter", "a,echo a")])
+        self.assertEqual(diff.update_items, [])
+
+    def test_not_support_params(self):
+        lines = ["Server=10.0.0.1", "AllowRoot=1", "LoadModule=a.so", "LoadModule=b.so"]
+        diff = self.diff(lines, ["Server=10.0.0.1"])
+        self.assertEqual(diff.unsupported_items, [("AllowRoot", "1"), ("LoadModule", "a.so"), ("LoadModule", "b.so")])
+        self.assertEqual(diff.add_items, [("AllowRoot", "1"), ("LoadModule", "b.so")])
+        diff = self.diff(lines, ["Server=10.0.0.1"], ignore_not_support_params=True)
+        self.assertEqual(len(diff.unsupported_items), 3)
+        self.assertEqual(diff.add_items, [])
+
+    def test_ordered_items_keep_agentd_order(self):
+        rules = ["AllowKey=system.run[ls *]", "DenyKey=system.run[*]", "AllowKey=system.run[df *]"]
+        diff = self.diff(rules, ["DenyKey=system.run[*]"])
+        self.assertEqual(diff.ordered_items, [tuple(i.split("=", 1)) for i in rules])
+        self.assertEqual(diff.add_items, [])
+        self.assertTrue(diff)
+        # 值相同而顺序不同同样是差异
+        self.assertTrue(self.diff(rules, [rules[1], rules[0], rules[2]]).ordered_items)
+        self.assertFalse(self.diff(rules, rules))
+        # agentd 中没有规则时保留 agent2 的规则
+        self.assertFalse(self.diff(["Server=127.0.0.1"], ["Server=127.0.0.1"] + rules))
+
+class RewriteConfLinesTest(unittest.TestCase):
+    LINES = [
+        "### Option: Server\n",
+        "Server=127.0.0.1\n",
+        "### Option: Timeout\n",
+        "# Timeout=3\n",
+        "### Option: UserParameter\n",
+        "# UserParameter=\n",
+        "Hostname=Zabbix server",
+    ]
+
+    def test_update_in_place(self):
+        res = upgrade.rewrite_conf_lines(self.LINES, [("Server", "10.0.0.1")], [], [])
+        self.assertEqual(res[1], "Server = 10.0.0.1\n")
+        self.assertEqual(len(res), len(self.LINES))
+
+    def test_add_after_template(self):
+        res = upgrade.rewrite_conf_lines(self.LINES, [], [
+            ("UserParameter", "a,echo a"),
+            ("Timeout", "10"),
+            ("UserParameter", "b,echo b"),
+        ], [])
+        self.assertEqual(res[3:5], ["# Timeout=3\n", "Timeout = 10\n"])
+        self.assertEqual(res[6:9], ["# UserParameter=\n", "UserParameter = a,echo a\n", "UserParameter = b,echo b\n"])
+
+    def test_append_without_template(self):
+        res = upgrade.rewrite_conf_lines(self.LINES, [], [("ListenPort", "10051")], [])
+        # 最后一行没有换行时先补上
+        self.assertEqual(res[-2:], ["Hostname=Zabbix server\n", "ListenPort = 10051\n"])
+
+    def test_ignore_items(self):
+        res = upgrade.rewrite_conf_lines(self.LINES, [("Server", "10.0.0.1")], [("Timeout", "10")], ["Server", "Timeout"])
+        self.assertEqual("".join(res), "".join(self.LINES))
+
+    RULES = [("AllowKey", "system.run[ls *]"), ("DenyKey", "system.run[*]"), ("AllowKey", "system.run[df *]")]
+
+    def test_ordered_items_replace_in_place(self):
+        lines = ["Server=127.0.0.1\n", "DenyKey=system.run[*]\n", "Timeout=3\n", "AllowKey=system.run[ls *]\n"]
+        res = upgrade.rewrite_conf_lines(lines, [], [], [], ordered_items=self.RULES)
+        self.assertEqual(res, [
+            "Server=127.0.0.1\n",
+            "AllowKey = system.run[ls *]\n",
+            "DenyKey = system.run[*]\n",
+            "AllowKey = system.run[df *]\n",
+            "Timeout=3\n",
+        ])
+
+    def test_ordered_items_after_template(self):
+        lines = ["### Option: AllowKey\n", "# AllowKey=\n", "### Option: DenyKey\n", "# DenyKey=system.run[*]\n"]
+        res = upgrade.rewrite_conf_lines(lines, [], [], [], ordered_items=self.RULES)
+        self.assertEqual(res[2:5], ["AllowKey = system.run[ls *]\n", "DenyKey = system.run[*]\n",
+                                    "AllowKey = system.run[df *]\n"])
+        self.assertEqual(len(res), len(lines) + 3)
+        res = upgrade.rewrite_conf_lines(self.LINES, [], [], [], ordered_items=self.RULES)
+        self.assertEqual(res[-3:], ["AllowKey = system.run[ls *]\n", "DenyKey = system.run[*]\n",
+                                    "AllowKey = system.run[df *]\n"])
+
+class ConflictUpTest(TempDirTestCase):
+    def setUp(self):
+        super(ConflictUpTest, self).setUp()
+        self.include = self.write("zabbix_agentd.d/mysql.conf", [
+            "UserParameter=mysql.ping,mysqladmin ping | grep -c alive",
+            "UserParameter=custom.mysql.qps,/usr/local/bin/qps.sh",
+            "# UserParameter=mysql.version,mysql -V",
+        ])
+        self.agentd_conf = self.write("zabbix_agentd.conf", [
+            "Server=127.0.0.1",
+            "UserParameter=agent.ping,echo 1",
+            "UserParameter=custom.ok,echo 1",
+            "Include={!s}/*.conf".format(os.path.dirname(self.include)),
+        ])
+        self.originals = dict((p, self.read(p)) for p in (self.include, self.agentd_conf))
+
+    def test_check_conflict_up(self):
+        conflict_dict, up_dict = upgrade.check_conflict_up(self.agentd_conf)
+        self.assertEqual(conflict_dict, {
+            "@" + self.agentd_conf: ["agent.ping"],
+            self.include: ["mysql.ping"],
+        })
+        self.assertEqual(sorted(up_dict[self.include]), ["custom.mysql.qps", "mysql.ping"])
+
+    def test_scan_cache_invalidated(self):
+        os.utime(self.include, (1000000000, 1000000000))
+        self.assertIn("mysql.ping", upgrade.check_conflict_up(self.agentd_conf)[1][self.include])
+        # 原地改写且 inode、大小和 mtime 不变，只能由 invalidate_zbx_conf 丢弃缓存
+        with open(self.include, "r+") as f:
+            f.write("UserParameter=mysql.pong")
+        os.utime(self.include, (1000000000, 1000000000))
+        upgrade.invalidate_zbx_conf(os.path.relpath(self.include))
+        self.assertIn("mysql.pong", upgrade.check_conflict_up(self.agentd_conf)[1][self.include])
+
+    def test_deal_and_rollback(self):
+        upgrade.init_journal(os.path.join(self.tmp, "journal.jsonl"), os.path.join(self.tmp, "backup"))
+        self.addCleanup(upgrade.init_journal, None)
+        conflict_dict = upgrade.check_conflict_up(self.agentd_conf)[0]
+        changes = upgrade.deal_conflict_up(conflict_dict)
+        self.assertEqual(sorted(changes), sorted([self.include, self.agentd_conf]))
+        self.assertIn(upgrade.CONFLICT_LINE_PREFIX + "UserParameter=mysql.ping,", self.read(self.include))
+        self.assertIn("UserParameter=custom.mysql.qps,", self.read(self.include))
+        self.assertEqual(upgrade.check_conflict_up(self.agentd_conf)[0], {})
+        self.assertEqual(upgrade.rollback_journal(os.path.join(self.tmp, "journal.jsonl"),
+                                                  os.path.join(self.tmp, "backup")), 2)
+        for path, content in self.originals.items():
+            self.assertEqual(self.read(path), content)
+
+    def test_rollback_moved_include(self):
+        moved = self.include + ".agent2upgrade.disable"
+        os.rename(self.include, moved)
+        other = self.write("zabbix_agentd.d/redis.conf", ["UserParameter=redis.qps,echo 1"])
+        os.rename(other, other + ".agent2upgrade.disable")
+        self.write("zabbix_agentd.d/redis.conf", ["UserParameter=redis.qps,echo 2"])
+        self.assertEqual(upgrade.rollback_conflict_up(self.agentd_conf), 1)
+        self.assertEqual(self.read(self.include), self.originals[self.include])
+        self.assertFalse(os.path.exists(moved))
+        # 原路径已存在的不覆盖
+        self.assertTrue(os.path.exists(other + ".agent2upgrade.disable"))
+
+class JournalTest(TempDirTestCase):
+    def setUp(self):
+        super(JournalTest, self).setUp()
+        self.journal_path = os.path.join(self.tmp, "journal.jsonl")
+        self.backup_dir = os.path.join(self.tmp, "backup")
+        upgrade.init_journal(self.journal_path, self.backup_dir)
+        self.addCleanup(upgrade.init_journal, None)
+        self.commands = []
+        self.installed = None
+        for name, func in (("query_rpm", lambda package: self.installed),
+                           ("lnx_command_execute", lambda command_lst: self.commands.append(command_lst) or True)):
+            self.addCleanup(setattr, upgrade, name, getattr(upgrade, name))
+            setattr(upgrade, name, func)
+
+    def rollback(self):
+        return upgrade.rollback_journal(self.journal_path, self.backup_dir)
+
+    def test_file_write(self):
+        changed = self.write("a.conf", ["Server=1.1.1.1"])
+        created = os.path.join(self.tmp, "b.conf")
+        upgrade.journal_write_file(changed, "Server=2.2.2.2\n")
+        upgrade.journal_write_file(changed, "Server=3.3.3.3\n")
+        upgrade.journal_write_file(created, "Server=4.4.4.4\n")
+        self.assertEqual(self.read(changed), "Server=3.3.3.3\n")
+        self.assertEqual(self.rollback(), 3)
+        self.assertEqual(self.read(changed), "Server=1.1.1.1\n")
+        self.assertFalse(os.path.exists(created))
+        self.assertFalse(os.path.exists(self.journal_path))
+
+    def test_entries_skip_broken_line(self):
+        upgrade.journal_record("service", service="zabbix-agent", active=True, enabled=True)
+        with open(self.journal_path, "a") as f:
+            f.write('{"seq": 2, "op"')
+        self.assertEqual([e["seq"] for e in upgrade.Journal(self.journal_path, self.backup_dir).entries()], [1])
+
+    def test_rpm_intent_not_applied(self):
+        upgrade.journal_record("rpm", package="zabbix-agent2", previous=None, installed="/tmp/agent2.rpm")
+        self.assertEqual(self.rollback(), 1)
+        self.assertEqual(self.commands, [])
+
+    def test_rpm_intent_applied_without_done(self):
+        upgrade.journal_record("rpm", package="zabbix-agent2", previous=None, installed="/tmp/agent2.rpm")
+        self.installed = "zabbix-agent2-5.0.1-1.el7.x86_64"
+        self.rollback()
+        self.assertEqual(self.commands, [["rpm", "-evh", "zabbix-agent2"]])
+
+    def test_rpm_done(self):
+        intent = upgrade.journal_record("rpm", package="zabbix-agent2", previous=None, installed="/tmp/agent2.rpm")
+        upgrade.journal_record("rpm_done", intent=intent["seq"], ok=True)
+        self.assertEqual(self.rollback(), 2)
+        self.assertEqual(self.commands, [["rpm", "-evh", "zabbix-agent2"]])
+
+    def test_rollback_agentd_only_replays_journal(self):
+        agentd_conf = self.write("zabbix_agentd.conf", ["Server=127.0.0.1"])
+        upgrade.journal_record("service", service="zabbix-agent", active=True, enabled=True)
+        calls = []
+        for name, value in (("AGENTD_CONF", agentd_conf),
+                            ("JOURNAL_PATH", self.journal_path),
+                            ("rollback_journal", lambda: calls.append("journal") or 1),
+                            ("rollback_conflict_up", lambda conf_path: calls.append("sweep") or 0),
+                            ("get_agent_listen", lambda conf_path: ("127.0.0.1", 10050)),
+                            ("wait_agent_ready", lambda host, port: 0.1)):
+            self.addCleanup(setattr, upgrade, name, getattr(upgrade, name))
+            setattr(upgrade, name, value)
+        upgrade.rollback_agentd()
+        self.assertEqual(calls, ["journal"])
+
+class CheckpointTest(TempDirTestCase):
+    def setUp(self):
+        super(CheckpointTest, self).setUp()
+        self.path = os.path.join(self.tmp, "state", "checkpoint.json")
+
+    def test_done_and_reload(self):
+        checkpoint = upgrade.Checkpoint(self.path)
+        checkpoint.done("install", "fp1", rpm="/tmp/agent2.rpm")
+        checkpoint = upgrade.Checkpoint(self.path)
+        self.assertEqual(checkpoint.get("install")["rpm"], "/tmp/agent2.rpm")
+        self.assertIsNotNone(checkpoint.get("install", "fp1"))
+        self.assertIsNone(checkpoint.get("install", "fp2"))
+        self.assertIsNone(checkpoint.get("conv"))
+
+    def test_redo_drops_later_phases(self):
+        checkpoint = upgrade.Checkpoint(self.path)
+        for phase in upgrade.CHECKPOINT_PHASES:
+            checkpoint.done(phase, "fp1")
+        checkpoint.done("conv", "fp2")
+        self.assertEqual(sorted(upgrade.Checkpoint(self.path).phases), ["conv", "install"])
+
+    def test_skip(self):
+        checkpoint = upgrade.Checkpoint(self.path)
+        checkpoint.done("install", "fp1")
+        self.assertTrue(checkpoint.skip("install", "fp1", lambda rec: True))
+        self.assertFalse(checkpoint.skip("install", "fp1", lambda rec: False))
+        self.assertFalse(checkpoint.skip("install", "fp2", lambda rec: True))
+        self.assertFalse(checkpoint.skip("conv", "fp1", lambda rec: True))
+
+    def test_skip_verify_error(self):
+        checkpoint = upgrade.Checkpoint(self.path)
+        checkpoint.done("install", "fp1")
+        self.assertFalse(checkpoint.skip("install", "fp1", lambda rec: 1 / 0))
+
+class PluginCapacityTest(TempDirTestCase):
+    USED = {"Mysql": 2, "SystemRun": 1, "UserParameter": 3}
+
+    def capacity(self, agentd_lines, used=USED, mode="startagents", cpu_count=None):
+        agentd_conf = upgrade.load_zbx_conf(self.write("agentd.conf", agentd_lines))
+        return dict(upgrade.plugin_capacity_items(agentd_conf, used, mode, cpu_count))
+
+    def test_plugin_of(self):
+        self.assertEqual(upgrade.agent2_plugin_of("mysql.ping"), "Mysql")
+        self.assertEqual(upgrade.agent2_plugin_of("system.cpu.util[,idle]"), "Cpu")
+        self.assertEqual(upgrade.agent2_plugin_of("net.if.in[eth0]"), "NetIf")
+        self.assertIsNone(upgrade.agent2_plugin_of("custom.mysql.qps"))
+        self.assertIsNone(upgrade.agent2_plugin_of("log"))
+
+    def test_used_plugins(self):
+        agentd_conf = upgrade.load_zbx_conf(self.write("agentd.conf", [
+            "EnableRemoteCommands=1", "Alias=db.ping:mysql.ping", "Alias=broken"]))
+        used = upgrade.used_agent2_plugins(agentd_conf, {"/etc/a.conf": ["mysql.version", "custom.x"]}, 3)
+        self.assertEqual(used, {"Mysql": 2, "SystemRun": 1, "UserParameter": 3})
+        agentd_conf = upgrade.load_zbx_conf(self.write("agentd.conf", ["Server=127.0.0.1"]))
+        self.assertEqual(upgrade.used_agent2_plugins(agentd_conf, {}, 0), {})
+
+    def test_startagents(self):
+        res = self.capacity(["StartAgents=5"])
+        self.assertEqual(res, {"Plugins.Mysql.Capacity": "5", "Plugins.SystemRun.Capacity": "5",
+                               "Plugins.UserParameter.Capacity": "5"})
+
+    def test_skip(self):
+        self.assertEqual(self.capacity(["StartAgents=5"], mode="none"), {})
+        self.assertEqual(self.capacity(["StartAgents=0"]), {})
+        self.assertEqual(self.capacity(["Server=127.0.0.1"]), {})
+        self.assertEqual(self.capacity(["StartAgents=5"], used={}), {})
+        self.assertRaises(Exception, self.capacity, ["StartAgents=5"], mode="bad")
+
+    def test_auto(self):
+        used = {"Mysql": 2, "SystemRun": 1, "UserParameter": 300}
+        res = self.capacity(["StartAgents=3"], used=used, mode="auto", cpu_count=2)
+        capacities = dict((k, int(v)) for k, v in res.items())
+        # 总并发为 max(StartAgents, CPU 数 * PLUGIN_CAPACITY_PER_CPU)，每个插件至少为 1
+        self.assertEqual(sum(capacities.values()), 2 * upgrade.PLUGIN_CAPACITY_PER_CPU)
+        self.assertEqual(min(capacities.values()), 1)
+        self.assertGreater(capacities["Plugins.UserParameter.Capacity"], capacities["Plugins.Mysql.Capacity"])
+        # 无法得到 CPU 数时按 StartAgents
+        self.assertEqual(set(self.capacity(["StartAgents=3"], mode="auto").values()), set(["3"]))
+
+    def test_merge(self):
+        agent2_conf = upgrade.load_zbx_conf(self.write("agent2.conf", [
+            "Plugins.Mysql.Capacity=5", "Plugins.Redis.Capacity=10"]))
+        diff = upgrade.ConfDiff()
+        diff.merge(agent2_conf, [("Plugins.Mysql.Capacity", "5"), ("Plugins.Redis.Capacity", "5"),
+                                 ("Plugins.Agent.Capacity", "5")])
+        self.assertEqual(diff.update_items, [("Plugins.Redis.Capacity", "5")])
+        self.assertEqual(diff.add_items, [("Plugins.Agent.Capacity", "5")])
+
+class UpAuditTest(TempDirTestCase):
+    def test_classify(self):
+        self.assertEqual(upgrade.classify_up_command("cpu.num", "nproc"), ("system.cpu.num[online]", True))
+        self.assertEqual(upgrade.classify_up_command("conf.md5", "md5sum /etc/hosts | awk '{print $1}'"),
+                         ("vfs.file.md5sum[/etc/hosts]", True))
+        self.assertEqual(upgrade.classify_up_command("nginx.procs", "pgrep -c nginx"), ("proc.num[nginx]", False))
+        # system.uname 与 uname -a 的输出格式不同
+        self.assertEqual(upgrade.classify_up_command("os.uname", "uname -a"), ("system.uname", False))
+        self.assertEqual(upgrade.classify_up_command("cpu.num[*]", "nproc"), (None, False))
+        self.assertEqual(upgrade.classify_up_command("custom.qps", "/usr/local/bin/qps.sh"), (None, False))
+
+    def test_count_forks(self):
+        self.assertEqual(upgrade.count_up_forks("nproc"), 2)
+        self.assertEqual(upgrade.count_up_forks("cat /proc/loadavg | awk '{print $1}'"), 3)
+        self.assertEqual(upgrade.count_up_forks("test -f /tmp/a && echo 1 || echo 0"), 1)
+
+    def test_audit_and_rewrite(self):
+        include = self.write("zabbix_agentd.d/custom.conf", [
+            "UserParameter=cpu.num,nproc",
+            "UserParameter=nginx.procs,pgrep -c nginx",
+            "UserParameter=mysql.ping,mysqladmin ping | grep -c alive",
+            "UserParameter=custom.qps,/usr/local/bin/qps.sh",
+        ])
+        agentd_conf = self.write("zabbix_agentd.conf", [
+            "Include={!s}/*.conf".format(os.path.dirname(include)),
+        ])
+        agent2_conf = self.write("zabbix_agent2.conf", ["Server=127.0.0.1"])
+        originals = dict((p, self.read(p)) for p in (include, agent2_conf))
+
+        audit = upgrade.audit_up(agentd_conf, {"cpu.num": 30})
+        actions = dict((i["key"], i["action"]) for i in audit["items"])
+        self.assertEqual(actions, {"cpu.num": "rewrite", "nginx.procs": "propose",
+                                   "mysql.ping": "conflict", "custom.qps": "keep"})
+        self.assertEqual(audit["rewrite_forks_per_min"], 4)
+
+        upgrade.init_journal(os.path.join(self.tmp, "journal.jsonl"), os.path.join(self.tmp, "backup"))
+        self.addCleanup(upgrade.init_journal, None)
+        self.assertEqual(upgrade.apply_up_rewrite(audit, agent2_conf), 4)
+        self.assertIn(upgrade.UP_REWRITE_LINE_PREFIX + "UserParameter=cpu.num,nproc", self.read(include))
+        self.assertIn("UserParameter=nginx.procs,", self.read(include).splitlines()[1])
+        self.assertEqual(self.read(agent2_conf), "Server=127.0.0.1\nAlias=cpu.num:system.cpu.num[online]\n")
+        # 重复执行时已改写的行依然列出
+        self.assertEqual(len(upgrade.audit_up(agentd_conf)["items"]), 4)
+
+        upgrade.rollback_journal(os.path.join(self.tmp, "journal.jsonl"), os.path.join(self.tmp, "backup"))
+        for path, content in originals.items():
+            self.assertEqual(self.read(path), content)
+
+    def test_disable_up_lines(self):
+        conf = self.write("a.conf", ["UserParameter=a,echo a", "# UserParameter=b,echo b", "UserParameter=b,echo b"])
+        changes = upgrade.disable_up_lines(conf, ["b", "c"], "#x# ")
+        self.assertEqual([c["line"] for c in changes], [3])
+        self.assertEqual(self.read(conf), "UserParameter=a,echo a\n# UserParameter=b,echo b\n#x# UserParameter=b,echo b\n")
+        self.assertEqual(upgrade.disable_up_lines(conf, ["c"], "#x# "), [])
+
+class FakeRpmHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """支持 Range、If-Range 和 If-None-Match 的 HTTP 替身，cut 次数内的完整请求只发送一半内容后断开，
+    length 为 False 时不发送 Content-Length。
+    """
+    data = ""
+    etag = None
+    length = True
+    cut = 0
+    ranges = []
+    if_ranges = []
+
+    def do_GET(self):
+        rng = self.headers.getheader("Range")
+        if_range = self.headers.getheader("If-Range")
+        self.ranges.append(rng)
+        self.if_ranges.append(if_range)
+        body = self.data
+        if self.etag and self.headers.getheader("If-None-Match") == self.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        if if_range is not None and if_range != self.etag:
+            rng = None
+        if rng:
+            offset = int(rng.split("=")[1].rstrip("-"))
+            if offset >= len(body):
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{!s}".format(len(body)))
+                self.end_headers()
+                return
+            self.send_response(206)
+            body = body[offset:]
+        else:
+            self.send_response(200)
+        if self.length:
+            self.send_header("Content-Length", str(len(body)))
+        if self.etag:
+            self.send_header("ETag", self.etag)
+        self.end_headers()
+        if not rng and self.cut > 0:
+            FakeRpmHandler.cut -= 1
+            body = body[:len(body) // 2]
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class DownloadTest(TempDirTestCase):
+    def setUp(self):
+        super(DownloadTest, self).setUp()
+        FakeRpmHandler.data = os.urandom(300 * 1024)
+        FakeRpmHandler.etag = '"v1"'
+        FakeRpmHandler.length = True
+        FakeRpmHandler.cut = 0
+        FakeRpmHandler.ranges = []
+        FakeRpmHandler.if_ranges = []
+        self.sha256 = hashlib.sha256(FakeRpmHandler.data).hexdigest()
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), FakeRpmHandler)
+        t = threading.Thread(target=self.server.serve_forever)
+        t.daemon = True
+        t.start()
+        self.url = "http://127.0.0.1:{!s}/zabbix-agent2.rpm".format(self.server.server_port)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        super(DownloadTest, self).tearDown()
+
+    def write_part(self, data, etag=None):
+        path = os.path.join(self.tmp, "pkg.part")
+        with open(path, "wb") as f:
+            f.write(data)
+        if etag:
+            with open(path + ".meta", "w") as f:
+                json.dump({"etag": etag}, f)
+        return path
+
+    def test_resume_partial_file_with_sha256(self):
+        path = self.write_part(FakeRpmHandler.data[:1000])
+        upgrade.download_url(self.url, path, sha256=self.sha256)
+        self.assertEqual(FakeRpmHandler.ranges, ["bytes=1000-"])
+        self.assertEqual(upgrade.file_sha256(path), self.sha256)
+
+    def test_restart_partial_file_without_validator(self):
+        path = self.write_part(FakeRpmHandler.data[:1000])
+        upgrade.download_url(self.url, path)
+        self.assertEqual(FakeRpmHandler.ranges, [None])
+        self.assertEqual(upgrade.file_sha256(path), self.sha256)
+
+    def test_resume_after_interrupted(self):
+        FakeRpmHandler.cut = 1
+        path = os.path.join(self.tmp, "pkg.part")
+        self.assertEqual(upgrade.download_url(self.url, path)["etag"], '"v1"')
+        self.assertEqual(FakeRpmHandler.ranges, [None, "bytes={!s}-".format(len(FakeRpmHandler.data) // 2)])
+        self.assertEqual(FakeRpmHandler.if_ranges, [None, '"v1"'])
+        self.assertEqual(upgrade.file_sha256(path), self.sha256)
+        self.assertFalse(os.path.exists(path + ".meta"))
+
+    def test_resume_changed_upstream(self):
+        path = self.write_part(os.urandom(1000), etag='"v0"')
+        upgrade.download_url(self.url, path)
+        self.assertEqual(FakeRpmHandler.if_ranges, ['"v0"'])
+        self.assertEqual(upgrade.file_sha256(path), self.sha256)
+
+    def test_complete_partial_file(self):
+        path = self.write_part(FakeRpmHandler.data, etag='"v1"')
+        self.assertTrue(upgrade.download_url(self.url, path)["verified"])
+        self.assertEqual(FakeRpmHandler.ranges, ["bytes={!s}-".format(len(FakeRpmHandler.data))])
+        self.assertEqual(upgrade.file_sha256(path), self.sha256)
+
+    def test_oversized_partial_file(self):
+        path = self.write_part(FakeRpmHandler.data + "x" * 10, etag='"v1"')
+        upgrade.download_url(self.url, path)
+        self.assertEqual(FakeRpmHandler.ranges[1:], [None])
+        self.assertEqual(upgrade.file_sha256(path), self.sha256)
+
+    def test_fetch_rpm_without_content_length(self):
+        FakeRpmHandler.length = False
+        FakeRpmHandler.cut = 1
+        commands = []
+        self.addCleanup(setattr, upgrade, "lnx_command_execute", upgrade.lnx_command_execute)
+        upgrade.lnx_command_execute = lambda command_lst: commands.append(command_lst[:3]) or False
+        cache_dir = os.path.join(self.tmp, "cache")
+        # 被截断的下载无法由大小发现，以 rpm -K 检查
+        self.assertRaises(Exception, upgrade.fetch_rpm, self.url, cache_dir=cache_dir)
+        self.assertEqual(commands, [["rpm", "-K", "--nosignature"]])
+        self.assertEqual([i for i in os.listdir(cache_dir) if i.endswith(".part")], [])
+        # 给出 sha256 时以 sha256 校验
+        path = upgrade.fetch_rpm(self.url, self.sha256, cache_dir=cache_dir)
+        self.assertEqual(upgrade.file_sha256(path), self.sha256)
+        self.assertEqual(len(commands), 1)
+
+    def test_fetch_rpm_cache(self):
+        cache_dir = os.path.join(self.tmp, "cache")
+        path = upgrade.fetch_rpm(self.url, self.sha256, cache_dir=cache_dir)
+        self.assertEqual(upgrade.file_sha256(path), self.sha256)
+        self.assertEqual(os.path.dirname(path), os.path.join(cache_dir, self.sha256))
+        # 已缓存的包不再下载，未给出 sha256 时按索引查找，并以条件请求确认服务端的文件未变化
+        self.assertEqual(upgrade.fetch_rpm(self.url, self.sha256.upper(), cache_dir=cache_dir), path)
+        self.assertEqual(len(FakeRpmHandler.ranges), 1)
+        self.assertEqual(upgrade.fetch_rpm(self.url, cache_dir=cache_dir), path)
+        self.assertEqual(len(FakeRpmHandler.ranges), 2)
+
+    def test_fetch_rpm_changed_upstream(self):
+        cache_dir = os.path.join(self.tmp, "cache")
+        old_path = upgrade.fetch_rpm(self.url, cache_dir=cache_dir)
+        FakeRpmHandler.data = os.urandom(1000)
+        FakeRpmHandler.etag = '"v2"'
+        path = upgrade.fetch_rpm(self.url, cache_dir=cache_dir)
+        self.assertNotEqual(path, old_path)
+        self.assertEqual(upgrade.file_sha256(path), hashlib.sha256(FakeRpmHandler.data).hexdigest())
+        # 没有 ETag/Last-Modified 时无法确认，重新下载
+        FakeRpmHandler.etag = None
+        FakeRpmHandler.data = os.urandom(1000)
+        path = upgrade.fetch_rpm(self.url, cache_dir=cache_dir)
+        self.assertEqual(upgrade.fetch_rpm(self.url, cache_dir=cache_dir), path)
+        self.assertEqual(len(FakeRpmHandler.ranges), 6)
+
+    def test_fetch_rpm_sha256_mismatch(self):
+        cache_dir = os.path.join(self.tmp, "cache")
+        self.assertRaises(Exception, upgrade.fetch_rpm, self.url, "0" * 64, cache_dir=cache_dir)
+        self.assertEqual([i for i in os.listdir(cache_dir) if i.endswith(".part")], [])
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class FakeAgent(object):
+    """Zabbix 被动检查协议的替身监听。
+
+    Args:
+        values: {<key>: <value>}，不在其中的 key 返回 ZBX_NOTSUPPORTED，为 None 时接受连接后直接关闭。
+        delays: 可选，{<key>: <返回前等待的秒数>}。
+        port: 可选，监听端口，默认随机。
+        start_after: 可选，延迟多少秒后才开始监听。
+    """
+    def __init__(self, values, delays=None, port=None, start_after=0):
+        self.values = values
+        self.delays = delays or {}
+        self.port = port or free_port()
+        self.requests = []
+        self.sock = None
+        self.stopped = False
+        t = threading.Thread(target=self.serve, args=(start_after,))
+        t.daemon = True
+        t.start()
+        if not start_after:
+            while self.sock is None:
+                time.sleep(0.01)
+
+    def serve(self, start_after):
+        time.sleep(start_after)
+        sock = socket.socket()
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("127.0.0.1", self.port))
+        sock.listen(50)
+        self.sock = sock
+        while not self.stopped:
+            try:
+                conn, _ = sock.accept()
+            except socket.error:
+                return
+            t = threading.Thread(target=self.handle, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def handle(self, conn):
+        try:
+            data = conn.recv(4096)
+            key = data[13:] if data.startswith("ZBXD") else data.strip()
+            self.requests.append(key)
+            if self.values is None:
+                return
+            time.sleep(self.delays.get(key, 0))
+            value = self.values.get(key, "ZBX_NOTSUPPORTED\0Unsupported item key.")
+            conn.sendall("ZBXD\x01" + struct.pack("<Q", len(value)) + value)
+        finally:
+            conn.close()
+
+    def close(self):
+        self.stopped = True
+        if self.sock is not None:
+            self.sock.close()
+
+class PassiveGetTest(unittest.TestCase):
+    def test_value(self):
+        agent = FakeAgent({"agent.ping": "1", "system.hostname": "h1"})
+        try:
+            self.assertEqual(upgrade.zbx_passive_get("127.0.0.1", agent.port, "system.hostname"), "h1")
+            self.assertTrue(upgrade.zbx_passive_get("127.0.0.1", agent.port, "my.key").startswith("ZBX_NOTSUPPORTED"))
+            self.assertEqual(agent.requests, ["system.hostname", "my.key"])
+        finally:
+            agent.close()
+
+    def test_rejected(self):
+        agent = FakeAgent(None)
+        try:
+            self.assertEqual(upgrade.zbx_passive_get("127.0.0.1", agent.port, "agent.ping"), "")
+        finally:
+            agent.close()
+
+    def test_refused(self):
+        self.assertRaises(socket.error, upgrade.zbx_passive_get, "127.0.0.1", free_port(), "agent.ping")
+
+class WaitAgentReadyTest(unittest.TestCase):
+    def test_ready_after_start(self):
+        agent = FakeAgent({"agent.ping": "1"}, start_after=0.5)
+        try:
+            elapsed = upgrade.wait_agent_ready("127.0.0.1", agent.port, timeout=5)
+            self.assertIsNotNone(elapsed)
+            self.assertGreaterEqual(elapsed, 0.4)
+            self.assertLess(elapsed, 3)
+        finally:
+            agent.close()
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertIsNone(upgrade.wait_agent_ready("127.0.0.1", free_port(), timeout=0.5))
+        self.assertLess(time.time() - start, 2)
+
+class ParityTest(unittest.TestCase):
+    def setUp(self):
+        self.before = FakeAgent({
+            "agent.ping": "1",
+            "system.hostname": "h1",
+            "system.uptime": "100",
+            "my.float": "10.0",
+            "my.text": "x",
+            "my.gone": "5",
+            "my.slow": "1",
+        })
+        self.after = FakeAgent({
+            "agent.ping": "1",
+            "system.hostname": "h1",
+            "system.uptime": "200",
+            "my.float": "10.2",
+            "my.text": "y",
+            "my.slow": "1",
+        }, delays={"my.slow": 0.1})
+
+    def tearDown(self):
+        self.before.close()
+        self.after.close()
+
+    def test_parity_agents(self):
+        keys = ["agent.ping", "system.hostname", "system.uptime", "my.float", "my.text", "my.gone", "my.slow", "my.none"]
+        report = upgrade.parity_agents(("127.0.0.1", self.before.port), ("127.0.0.1", self.after.port), keys)
+        items = report["items"]
+        self.assertEqual(report["keys"], len(keys))
+        self.assertEqual(sorted(report["regressions"]), ["my.gone", "my.slow", "my.text"])
+        self.assertEqual(items["my.text"]["regressions"], ["value"])
+        self.assertEqual(items["my.gone"]["regressions"], ["unsupported"])
+        self.assertEqual(items["my.slow"]["regressions"], ["latency"])
+        # 随时间变化的 key 和误差内的数值不算回退，切换前就不支持的 key 不比较
+        for key in ("system.uptime", "my.float", "my.none"):
+            self.assertEqual(items[key]["regressions"], [])
+        self.assertEqual(len(self.before.requests), len(keys) * upgrade.PARITY_SAMPLES)
+
+    def test_unreachable(self):
+        before = upgrade.parity_sample("127.0.0.1", self.before.port, ["agent.ping"], samples=2)
+        after = upgrade.parity_sample("127.0.0.1", free_port(), ["agent.ping"], samples=2, timeout=0.5)
+        self.assertEqual(upgrade.parity_compare(before, after)["items"]["agent.ping"]["regressions"], ["unreachable"])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+    unittest.main()
@@ -4,9 +4,37 @@
 # Author: AcidGo
 # Usage:
 #   url: 指定安装包的资源路径。
+#   rpm_sha256: 可选，安装包的 sha256 校验值，下载后校验并用于本地缓存的查找。
 #   can_remove: 是否允许已部署的 Agent2 卸载。
 #   deal_with_up: 是否允许解决冲突 UserParameter。
 #   exec_rollback: 是否执行回滚操作。
+#   plugin_capacity: 可选，StartAgents 转换为 agent2 插件 Capacity 的方式，startagents（默认）、auto 或 none，见 PLUGIN_CAPACITY_MODE。
+#   up_rewrite: 可选，是否将与内置 key 等价的 UserParameter 改写为 agent2 的 Alias，见 UP_REWRITE_RULES。
+#   up_intervals: 可选，audit 模式和 up_rewrite 估算 fork 数时使用的采集间隔，JSON 文件 {<key>: <秒数>} 的路径，
+#       默认 UP_AUDIT_DEFAULT_INTERVAL；fleet 模式下读取后下发到目标主机。
+#   parity_check: 可选，是否在切换前后对比 agentd 和 agent2 对各 key 的返回值和延迟，标记回退的 key。
+#   fast_cutover: 可选，是否使用最小中断的切换方式，先校验 agent2 配置，再合并 stop/disable 和 start/enable 切换服务。
+#   mode: 运行模式，upgrade（默认，升级本机）、plan（只读地计算升级会做的改动）、
+#       bulk（离线批量转换主机配置快照）、fleet（批量并发升级多台主机）、report（汇总事件流的耗时分位数）
+#       audit（只读地评估 UserParameter 的 fork 开销及可改写为内置 key 的项）
+#       parity（对比两个 agent 对各 key 的返回值和延迟）
+#       或 sync（常驻运行，将 agentd 配置及 Include 文件的改动增量同步到 agent2，用于分批升级的过渡期）。
+#   agent2_template: plan 模式下 agent2 配置模板的来源，可以是 rpm 包的 URL/路径或 zabbix_agent2.conf 的路径，默认使用 url。
+#   plan_output: 可选，plan 模式下 JSON 结果的输出路径，默认输出到标准输出。
+#   bulk_store: bulk 模式下主机配置快照的目录，其下每个子目录为一台主机的根目录，如 <bulk_store>/<host>/etc/zabbix/zabbix_agentd.conf。
+#   bulk_output: bulk 模式下的输出目录，每台主机输出 <bulk_output>/<host>/zabbix_agent2.conf，汇总于 summary.json。
+#   bulk_workers: bulk 模式下的进程数，默认为 CPU 数。
+#   fleet_remote_mode: fleet 模式下目标主机执行的模式，默认 upgrade，可以为 plan、audit 或 parity。
+#   parity_before: parity 模式下作为基准的 agent，<host>:<port>，默认为 agentd 配置的监听地址。
+#   parity_after: parity 模式下对比的 agent，<host>:<port>，默认为 agent2 配置的监听地址。
+#   parity_keys: 可选，额外对比的 key，逗号分隔，如带参数的 UserParameter 的具体 key。
+#   sync_once: 可选，sync 模式下只同步一次后退出，用于由 cron 等定时执行。
+#   event_log: 可选，JSON-lines 事件流的输出路径，"-" 表示输出到标准输出。
+#   event_files: report 模式下读取的事件流文件，逗号分隔，支持通配符。
+#   fleet_hosts: fleet 模式下的主机列表，可以是文件路径（每行一个）或逗号分隔的字符串。
+#   fleet_transport: fleet 模式下的传输方式，见 FLEET_TRANSPORTS，默认 ssh。
+#   fleet_workers: fleet 模式下的并发数。
+#   fleet_state: fleet 模式下的状态文件路径（每行一条主机记录），中断后再次执行会跳过以相同任务执行成功的主机。
 
 
 from __future__ import print_function
@@ -15,10 +43,24 @@ import logging
 import shutil
 import re
 import subprocess
+import json
+import hashlib
+import math
+import socket
+import struct
+import threading
 
-from collections import OrderedDict
-from ConfigParser import RawConfigParser
-from StringIO import StringIO
+import signal
+import tempfile
+import multiprocessing
+import select
+import errno
+import ctypes
+import ctypes.util
+
+from collections import OrderedDict, deque, namedtuple
+from contextlib import contextmanager
+from Queue import Queue, Empty
 
 
 # CONFIG
@@ -33,8 +75,70 @@ CONF_IGNORE_ITEM = [
     # Whereas disabling passive checks is not currently supported.
     "StartAgents",
 ]
-CONFLICT_SUFFIX = ".agent2upgrade.disable"
+# 允许在配置中重复出现的参数，比较时按值的集合进行比较，CONF_ORDERED_ITEMS 中的除外。
+CONF_MULTI_VALUE_ITEMS = [
+    "Include",
+    "UserParameter",
+    "Alias",
+    "AllowKey",
+    "DenyKey",
+]
+# agent 按出现的顺序逐条匹配的规则，第一条匹配的生效，转换时作为整体保持 agentd 中的相对顺序。
+CONF_ORDERED_ITEMS = [
+    "AllowKey",
+    "DenyKey",
+]
+# 冲突的 UserParameter 行会加上该前缀注释掉，改动记录于 JOURNAL_PATH，回滚时据此恢复。
+CONFLICT_LINE_PREFIX = "#agent2upgrade.disable# "
+# 改写为 Alias 的 UserParameter 行会加上该前缀注释掉，改动同样记录于 JOURNAL_PATH。
+UP_REWRITE_LINE_PREFIX = "#agent2upgrade.alias# "
+# 升级过程中所有改动的日志，以及被改写文件的原始内容的备份目录，回滚时逆序重放。
+JOURNAL_PATH = "/var/lib/zbx_agent2upgrade/journal.jsonl"
+JOURNAL_BACKUP_DIR = "/var/lib/zbx_agent2upgrade/backup"
+# 各阶段完成情况和输入指纹的记录，以及 rpm 安装后 agent2 原始配置的副本，重复执行时跳过已完成的阶段。
+CHECKPOINT_PATH = "/var/lib/zbx_agent2upgrade/checkpoint.json"
+CHECKPOINT_AGENT2_CONF = "/var/lib/zbx_agent2upgrade/zabbix_agent2.conf.orig"
+CHECKPOINT_PHASES = ["install", "conv", "enable"]
 CONF_BACKUP_SUFFIX = ".agent2upgrade.bak"
+# StartAgents 转换为 agent2 插件 Plugins.<name>.Capacity 的方式，只转换主机使用的插件：
+#   startagents: 每个插件的 Capacity 取 agentd 的 StartAgents；
+#   auto: 总并发按 CPU 数，在插件间按其服务的 key 数量分配；
+#   none: 不转换。
+PLUGIN_CAPACITY_MODE = "startagents"
+# Plugins.<name>.Capacity 的取值范围
+PLUGIN_CAPACITY_MIN = 1
+PLUGIN_CAPACITY_MAX = 100
+# auto 方式下每个 CPU 可用的被动检查并发数
+PLUGIN_CAPACITY_PER_CPU = 4
+# from https://www.zabbix.com/documentation/current/manual/config/items/plugins (5.2)
+# 提供被动检查 key 的 agent2 插件，以 "." 结尾的为 key 的命名空间。Log 插件只用于主动检查，不受 StartAgents 影响。
+CONF_AGENT2_PLUGINS = OrderedDict([
+    ("Agent", ["agent."]),
+    ("Ceph", ["ceph."]),
+    ("Cpu", ["system.cpu.discovery", "system.cpu.num", "system.cpu.util"]),
+    ("Docker", ["docker."]),
+    ("File", ["vfs.file."]),
+    ("Kernel", ["kernel."]),
+    ("Memcached", ["memcached."]),
+    ("Modbus", ["modbus."]),
+    ("MQTT", ["mqtt."]),
+    ("Mysql", ["mysql."]),
+    ("NetIf", ["net.if."]),
+    ("Oracle", ["oracle."]),
+    ("Postgres", ["pgsql."]),
+    ("Proc", ["proc.cpu.util"]),
+    ("Redis", ["redis."]),
+    ("Swap", ["system.swap.size"]),
+    ("SystemRun", ["system.run"]),
+    ("Systemd", ["systemd."]),
+    ("TCP", ["net.tcp.port"]),
+    ("UDP", ["net.udp.service", "net.udp.service.perf"]),
+    ("Uname", ["system.hostname", "system.sw.arch", "system.uname"]),
+    ("Uptime", ["system.uptime"]),
+    ("VFSDev", ["vfs.dev."]),
+    ("WebPage", ["web.page."]),
+    ("ZabbixStats", ["zabbix.stats"]),
+])
 # from https://www.zabbix.com/documentation/5.0/manual/concepts/agent2 (5.2)
 CONF_AGENT2_NOTSUPPORT_PARAMS = [
     # Not supported because daemonization is not supported.
@@ -84,6 +188,111 @@ CONF_CONFLICT_UP = [
     "vfs.dir.count", "vfs.dir.size", "vfs.fs.get", "vfs.fs.inode", "vfs.fs.size", 
     "vm.memory.size", 
 ]
+# UserParameter 命令可由 agent2 内置 key 代替的规则：(<完整匹配命令的正则>, <内置 key>, <是否可直接改写>)。
+# 可直接改写的与内置 key 的返回值一致，以 Alias 代替；其余返回格式不同，只给出建议，需同步修改模板中的监控项。
+UP_REWRITE_RULES = [
+    (r"cat\s+/proc/loadavg\s*\|\s*awk\s+'\{\s*print\s+\$1\s*\}'", "system.cpu.load[all,avg1]", True),
+    (r"cat\s+/proc/loadavg\s*\|\s*awk\s+'\{\s*print\s+\$2\s*\}'", "system.cpu.load[all,avg5]", True),
+    (r"cat\s+/proc/loadavg\s*\|\s*awk\s+'\{\s*print\s+\$3\s*\}'", "system.cpu.load[all,avg15]", True),
+    (r"nproc", "system.cpu.num[online]", True),
+    (r"hostname", "system.hostname", True),
+    (r"uname\s+-a", "system.uname", False),
+    (r"uname\s+-m", "system.sw.arch", True),
+    (r"cat\s+/proc/sys/fs/file-max", "kernel.maxfiles", True),
+    (r"cat\s+/proc/sys/kernel/pid_max", "kernel.maxproc", True),
+    (r"systemctl\s+is-active\s+([\w@-]+)(?:\.service)?", "systemd.unit.info[{0}.service,ActiveState]", True),
+    (r"md5sum\s+(/\S+)\s*\|\s*(?:awk\s+'\{\s*print\s+\$1\s*\}'|cut\s+-d\s*' '\s+-f\s*1)", "vfs.file.md5sum[{0}]", True),
+    (r"stat\s+-c\s*%s\s+(/\S+)", "vfs.file.size[{0}]", True),
+    (r"test\s+-[ef]\s+(/\S+)\s*&&\s*echo\s+1\s*\|\|\s*echo\s+0", "vfs.file.exists[{0}]", True),
+    (r"cat\s+(/[^\s|;&<>]+)", "vfs.file.contents[{0}]", True),
+    (r"pgrep\s+-c\s+([\w.-]+)", "proc.num[{0}]", False),
+    (r"mysqladmin\b.*\bping\b.*", "mysql.ping", False),
+    (r"mysql(?:admin)?\b.*(?:show\s+(?:global\s+)?status|extended-status).*", "mysql.get_status_variables", False),
+    (r"redis-cli\b.*\bping\b.*", "redis.ping", False),
+    (r"redis-cli\b.*\binfo\b.*", "redis.info", False),
+    (r"pg_isready\b.*", "pgsql.ping", False),
+    (r"docker\s+info\b.*", "docker.info", False),
+    (r"echo\s+stats\s*\|\s*nc\b.*", "memcached.stats", False),
+    (r"ceph\s+(?:-s|status)\b.*", "ceph.status", False),
+    (r"curl\b.*?(https?://[^\s'\"]+).*", "web.page.get[{0}]", False),
+]
+# 不会 fork 进程的 shell 内建命令，估算 fork 数时不计入。
+SHELL_BUILTINS = ["echo", "printf", "test", "[", "true", "false", "cd", "export", "exit", "read"]
+# 未知采集间隔时估算 fork 数使用的秒数
+UP_AUDIT_DEFAULT_INTERVAL = 60
+# agent2 插件独占的 key 命名空间，其下的任何 key 都视为与内置 key 冲突。
+CONF_CONFLICT_UP_PREFIX = [
+    "ceph.",
+    "docker.",
+    "memcached.",
+    "modbus.",
+    "mqtt.",
+    "oracle.",
+    "pgsql.",
+    "redis.",
+]
+# 单个命令的默认超时秒数，以及命令结果中保留的输出行数。
+COMMAND_TIMEOUT = 600
+COMMAND_OUTPUT_TAIL = 200
+# 服务启动后等待 agent 响应 agent.ping 的最长秒数，以及轮询的初始和最大间隔。
+AGENT_READY_TIMEOUT = 30
+AGENT_READY_INTERVAL = 0.05
+AGENT_READY_MAX_INTERVAL = 1
+# 切换前后对比 agent 的返回值和延迟：每个 key 的采样次数、并发连接数和单次超时秒数。
+PARITY_SAMPLES = 5
+PARITY_WORKERS = 4
+PARITY_TIMEOUT = 3
+# p50 延迟超过切换前的 (1 + PARITY_LATENCY_TOLERANCE) 倍，且增加超过 PARITY_LATENCY_MIN_DELTA 秒，视为延迟回退。
+PARITY_LATENCY_TOLERANCE = 0.5
+PARITY_LATENCY_MIN_DELTA = 0.01
+# 数值的相对误差在此范围内视为一致。
+PARITY_NUMERIC_TOLERANCE = 0.05
+# 切换前 agentd 的采样结果，agent2 启动后与之对比。
+PARITY_BASELINE_PATH = "/var/lib/zbx_agent2upgrade/parity_baseline.json"
+# 除 UserParameter 外默认对比的内置 key，agent.version 升级前后必然不同，不在其中。
+PARITY_BUILTIN_KEYS = [
+    "agent.ping", "agent.hostname",
+    "system.hostname", "system.uname", "system.sw.arch", "system.cpu.num", "system.cpu.load[all,avg1]", "system.uptime",
+    "kernel.maxfiles", "kernel.maxproc",
+    "vm.memory.size[total]", "vfs.fs.size[/,total]",
+]
+# 随时间变化的 key，只比较是否都支持。
+PARITY_VOLATILE_KEYS = [
+    "system.uptime", "system.localtime", "system.cpu.load", "system.cpu.util", "system.cpu.switches", "system.cpu.intr",
+    "system.swap.in", "system.swap.out", "system.users.num",
+    "vm.memory.size", "vfs.fs.size", "vfs.fs.inode", "vfs.dev.read", "vfs.dev.write",
+    "proc.num", "proc.mem", "proc.cpu.util",
+    "net.if.in", "net.if.out", "net.if.total", "net.if.collisions",
+]
+# sync 模式：没有 inotify 时的轮询间隔，有 inotify 时兜底的全量检查间隔，收到事件后合并连续改动的等待秒数。
+SYNC_POLL_INTERVAL = 5
+SYNC_RESCAN_INTERVAL = 300
+SYNC_DEBOUNCE = 1
+# sync 模式的状态：上次同步时各文件的状态、agentd 的配置项，以及是否有待重启的改动。
+SYNC_STATE_PATH = "/var/lib/zbx_agent2upgrade/sync.json"
+# 安装包的本地缓存目录，按 sha256 存放，重复执行或强制重装时不再重复下载。
+RPM_CACHE_DIR = "/var/cache/zbx_agent2upgrade"
+RPM_DOWNLOAD_TIMEOUT = 30
+RPM_DOWNLOAD_RETRY = 3
+# 并发扫描 Include 文件的线程数。
+INCLUDE_SCAN_WORKERS = 8
+# fleet 模式下传输方式的命令模板，{host} 会被替换为目标主机，脚本内容通过 stdin 传入。
+FLEET_TRANSPORTS = {
+    "ssh": ["ssh", "-o", "BatchMode=yes", "-o", "ConnectTimeout=10", "root@{host}", "python", "-"],
+    # 目标为本机的 chroot/fake-root 目录，用于测试。
+    "chroot": ["chroot", "{host}", "python", "-"],
+}
+FLEET_WORKERS = 20
+FLEET_HOST_TIMEOUT = 1800
+FLEET_STATE_PATH = "zbx_agent2upgrade.fleet.jsonl"
+FLEET_OUTPUT_TAIL = 50
+# 决定 fleet 任务的参数，记录于每台主机的状态中，只有以相同任务执行成功的主机才会被跳过，
+# 避免回滚或其他安装包的执行结果被当作已升级。
+FLEET_TASK_PARAMS = ["INPUT_MODE", "INPUT_ROLLBACK", "INPUT_AGENT2_RPM_URL", "INPUT_AGENT2_RPM_SHA256"]
+# 支持的运行模式，见 Usage 中的 mode。
+RUN_MODES = ["upgrade", "plan", "bulk", "fleet", "report", "audit", "parity", "sync"]
+# fleet 模式下目标主机可以执行的模式，见 Usage 中的 fleet_remote_mode。
+FLEET_REMOTE_MODES = ["upgrade", "plan", "audit", "parity"]
 # EOF CONFIG
 
 def init_logger(level, logfile=None):
@@ -96,6 +305,7 @@ def init_logger(level, logfile=None):
     """
     import os
     import sys
+    from logging.handlers import RotatingFileHandler
     if not logfile:
         logging.basicConfig(
             level = getattr(logging, level.upper()),
@@ -123,205 +333,1155 @@ def info_echo(panel, obj):
     print(s)
     print("="*10 + " {!s} ".format("EOF") + "="*10)
 
-def lnx_command_execute(command_lst):
+_EVENT_STREAM = None
+_EVENT_LOCK = threading.Lock()
+EVENT_RUN_ID = "{!s}-{!s}".format(int(time.time()), os.getpid())
+
+def init_event_stream(path):
+    """初始化 JSON-lines 事件流，与日志一起输出各阶段和命令的耗时。
+
+    Args:
+        path: 事件流文件路径，"-" 表示标准输出，为空则不输出。
+    """
+    global _EVENT_STREAM
+    if not path:
+        _EVENT_STREAM = None
+    elif path == "-":
+        _EVENT_STREAM = sys.stdout
+    else:
+        _EVENT_STREAM = open(path, "a")
+
+def write_event_line(line):
+    if _EVENT_STREAM is None:
+        return
+    with _EVENT_LOCK:
+        _EVENT_STREAM.write(line.rstrip("\n") + "\n")
+        _EVENT_STREAM.flush()
+
+def emit_event(event, **fields):
+    """输出一条事件，公共字段为 ts、host、run_id 和 event。
+    """
+    if _EVENT_STREAM is None:
+        return
+    record = {
+        "ts": round(time.time(), 6),
+        "host": platform.node(),
+        "run_id": EVENT_RUN_ID,
+        "event": event,
+    }
+    record.update(fields)
+    write_event_line(json.dumps(record, sort_keys=True))
+
+@contextmanager
+def phase_timer(name):
+    """记录一个阶段的耗时，写入日志和事件流。
+    """
+    start = time.time()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        duration = time.time() - start
+        logging.info("phase {!s} cost {:.3f}s".format(name, duration))
+        emit_event("phase", name=name, duration=round(duration, 6), ok=ok)
+
+def percentile(sorted_values, q):
+    """最近秩法计算已排序列表的分位数。
+    """
+    if not sorted_values:
+        return None
+    idx = int(math.ceil(q / 100.0 * len(sorted_values))) - 1
+    return sorted_values[min(max(idx, 0), len(sorted_values) - 1)]
+
+def aggregate_events(patterns):
+    """汇总多台主机的事件流，按阶段统计耗时的分位数。
+
+    Args:
+        patterns: 事件流文件路径列表，支持通配符。
+    Returns:
+        <OrderedDict>: {<name>: {"count", "p50", "p95", "p99", "max"}}，
+            phase 事件以阶段名统计，command/systemctl 事件以 "command:<程序名>"、"systemctl:<操作>" 统计。
+    """
+    durations = {}
+    for pattern in patterns:
+        for path in sorted(glob.glob(pattern)):
+            with open(path, "r") as f:
+                for line in f:
+                    if not line.startswith("{"):
+                        continue
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if "duration" not in record:
+                        continue
+                    if record.get("event") == "phase":
+                        name = record["name"]
+                    elif record.get("event") == "command":
+                        name = "command:" + os.path.basename(record["command"][0])
+                    elif record.get("event") == "systemctl":
+                        name = "systemctl:" + record["action"]
+                    else:
+                        name = record.get("event")
+                    durations.setdefault(name, []).append(record["duration"])
+
+    res = OrderedDict()
+    for name in sorted(durations):
+        values = sorted(durations[name])
+        res[name] = OrderedDict([
+            ("count", len(values)),
+            ("p50", percentile(values, 50)),
+            ("p95", percentile(values, 95)),
+            ("p99", percentile(values, 99)),
+            ("max", values[-1]),
+        ])
+    return res
+
+CommandResult = namedtuple("CommandResult", ["command", "returncode", "duration", "timed_out", "output"])
+
+def run_command(command_lst, timeout=COMMAND_TIMEOUT, input_data=None, log_level=logging.INFO,
+        log_prefix="", tail=COMMAND_OUTPUT_TAIL):
+    """执行命令，在命令运行时逐行将输出（stdout 和 stderr 合并）写入日志。
+
+    命令运行于独立的进程组，超时后整个进程组会被 kill 并回收，不会遗留子进程。
+
+    Args:
+        command_lst: 命令列表，shell 下命令的空格分段形式。
+        timeout: 超时秒数，为空则不限制。
+        input_data: 可选，写入命令 stdin 的内容。
+        log_level: 输出行的日志级别，为空则不记录。
+        log_prefix: 输出行在日志中的前缀。
+        tail: 结果中保留的最后输出行数，为空则全部保留。
+    Returns:
+        <CommandResult>: 命令、退出码（超时为 None）、耗时秒数、是否超时和输出行。
+    """
+    start = time.time()
+    pipe = subprocess.Popen(
+        command_lst,
+        stdin=subprocess.PIPE if input_data is not None else None,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        close_fds=True,
+        preexec_fn=os.setsid,
+    )
+    timed_out = threading.Event()
+    def kill():
+        timed_out.set()
+        try:
+            os.killpg(pipe.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer:
+        timer.daemon = True
+        timer.start()
+
+    if input_data is not None:
+        def write():
+            try:
+                pipe.stdin.write(input_data)
+                pipe.stdin.close()
+            except (IOError, OSError):
+                pass
+        writer = threading.Thread(target=write)
+        writer.daemon = True
+        writer.start()
+
+    output = deque(maxlen=tail)
+    try:
+        for line in iter(pipe.stdout.readline, b""):
+            line = line.rstrip("\n")
+            if log_level is not None:
+                logging.log(log_level, log_prefix + line)
+            output.append(line)
+        pipe.stdout.close()
+        pipe.wait()
+    finally:
+        if timer:
+            timer.cancel()
+        if pipe.returncode is None:
+            kill()
+            pipe.wait()
+
+    duration = time.time() - start
+    returncode = None if timed_out.is_set() else pipe.returncode
+    if timed_out.is_set():
+        logging.error("{!s}command {!s} is killed after {!s}s".format(log_prefix, command_lst, timeout))
+    emit_event("command", command=command_lst, returncode=returncode, duration=round(duration, 6),
+        timed_out=timed_out.is_set(), ok=returncode == 0)
+    return CommandResult(command_lst, returncode, duration, timed_out.is_set(), list(output))
+
+def lnx_command_execute(command_lst, timeout=COMMAND_TIMEOUT):
     """在 Linux 平台执行命令。
 
     Args:
         command_lst: 命令列表，shell 下命令的空格分段形式。
+        timeout: 超时秒数。
     Returns:
-        <bool> False: 执行返回非预期 exitcode。
+        <bool> False: 执行返回非预期 exitcode 或超时。
         <bool> True: 执行返回预期 exitcode。
     """
     logging.info("---------- {!s} ----------".format(command_lst))
-    try:
-        res = subprocess.check_output(command_lst, stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-        for i in e.output.split('\n'):
-            logging.error(i)
-        logging.info("-"*30)
-        return False
-    for i in [i for i in res.split('\n') if not i.strip()]:
-        logging.info(i)
+    res = run_command(command_lst, timeout)
     logging.info("-"*30)
+    if res.returncode != 0:
+        logging.error("command {!s} is failed, returncode: {!s}, cost {:.3f}s".format(
+            command_lst, res.returncode, res.duration))
+        return False
+    logging.debug("command {!s} cost {:.3f}s".format(command_lst, res.duration))
     return True
 
+_CONF_TEMPLATE_RE = re.compile(r"^\s*#\s*([^#=\s][^=]*?)\s*=")
+
+def tokenize_zbx_line(line, strict=False):
+    """按 Zabbix agent 的配置语法解析一行。
+
+    与 agent 一致：去掉首尾的空白后，空行和以 # 开头的整行为注释，其余按第一个 "=" 分为 key 和 value，
+    value 中的 "["、"#" 和之后的 "=" 都原样保留。
+
+    Args:
+        line: 配置文件的一行。
+        strict: 为 True 时，没有 "=" 或 key 为空的行抛出 ValueError，否则视为非生效行。
+    Returns:
+        <tuple>: (<key>, <value>)，注释和空行为 None。
+    """
+    line = line.strip(" \t\r\n")
+    if not line or line[0] == "#":
+        return None
+    key, sep, value = line.partition("=")
+    key = key.rstrip(" \t")
+    if not sep or not key:
+        if strict:
+            raise ValueError("invalid entry: {!r}".format(line))
+        return None
+    return key, value.lstrip(" \t")
+
+def iter_zbx_conf(path):
+    """逐行读取 Zabbix agent 的配置文件，依次产生生效的配置项，内存占用与文件大小无关。
+
+    Args:
+        path: 配置文件路径。
+    Returns:
+        <generator>: (<行号>, <key>, <value>)，重复的 key 按出现的顺序逐个产生。
+    """
+    with open(path, "r") as f:
+        for lineno, line in enumerate(f, 1):
+            try:
+                item = tokenize_zbx_line(line, strict=True)
+            except ValueError as e:
+                raise Exception("cannot parse {!s} at line {!s}: {!s}".format(path, lineno, e))
+            if item is not None:
+                yield lineno, item[0], item[1]
+
 def parse_zbx_conf(path, is_multi=False):
     """分析 zabbix-agentd 和 zabbix-agent 等的 conf 文件，转为换列表。
 
     Args:
         path: 配置文件路径。
+        is_multi: 为 True 时保留重复 key 的所有值，否则每个 key 只保留最后一个值。
     Returns:
         <list>: 配置文件的键值对。
     """
-    cp = RawConfigParser() if not is_multi else RawConfigParser(dict_type=MultiOrderedDict)
-    cp.optionxform = str
-    with open(path, "r") as f:
-        stream = StringIO("[dummy_section]\n" + f.read())
-        cp.readfp(stream)
-    return cp.items("dummy_section")
+    if is_multi:
+        return [(k, v) for _, k, v in iter_zbx_conf(path)]
+    res = OrderedDict()
+    for _, k, v in iter_zbx_conf(path):
+        res[k] = v
+    return list(res.items())
+
+class ZbxConf(object):
+    """单个配置文件的解析结果，按 key 建立索引，重复的 key 保留所有值。
+
+    Args:
+        path: 配置文件路径。
+        items: 按文件顺序的键值对列表，重复的 key 会展开为多项。
+        stat: 解析时配置文件的 os.stat 结果，用于判断缓存是否失效。
+
+    Attributes:
+        ordered_items: CONF_ORDERED_ITEMS 中的项按文件顺序的列表，[(<key>, <value>), ...]。
+    """
+    def __init__(self, path, items, stat):
+        self.path = path
+        self.mtime = stat.st_mtime
+        self.size = stat.st_size
+        self.index = OrderedDict()
+        self.ordered_items = []
+        ordered = set(CONF_ORDERED_ITEMS)
+        for k, v in items:
+            self.index.setdefault(k, []).append(v)
+            if k in ordered:
+                self.ordered_items.append((k, v))
+
+    def is_stale(self, stat):
+        return stat.st_mtime != self.mtime or stat.st_size != self.size
+
+    def items(self):
+        """与 parse_zbx_conf(path) 一致，重复的 key 只保留最后一个值。
+        """
+        return [(k, v[-1]) for k, v in self.index.items()]
+
+    def get(self, key, default=None):
+        if key not in self.index:
+            return default
+        return self.index[key][-1]
+
+    def get_all(self, key):
+        return list(self.index.get(key, []))
+
+_ZBX_CONF_CACHE = {}
+
+def load_zbx_conf(path):
+    """获取配置文件的解析结果，同一文件在未变更（mtime 和 size）前只解析一次。
+
+    Args:
+        path: 配置文件路径。
+    Returns:
+        <ZbxConf>: 配置文件的解析结果。
+    """
+    key = os.path.abspath(path)
+    stat = os.stat(key)
+    conf = _ZBX_CONF_CACHE.get(key)
+    if conf is None or conf.is_stale(stat):
+        conf = ZbxConf(key, ((k, v) for _, k, v in iter_zbx_conf(key)), stat)
+        _ZBX_CONF_CACHE[key] = conf
+    return conf
+
+def invalidate_zbx_conf(path):
+    """配置文件被本脚本改写后，丢弃其缓存的解析结果。
+    """
+    _ZBX_CONF_CACHE.pop(os.path.abspath(path), None)
+    with _UP_SCAN_LOCK:
+        _UP_SCAN_CACHE.pop(os.path.abspath(path), None)
+
+class BuiltinKeyMatcher(object):
+    """判断 UserParameter 的 key 是否与 agent2 的内置 key 冲突。
+
+    内置 key 以集合常数时间查找；带参数的 key（如 mysql.ping[*]）按去掉参数后的 key 判断；
+    插件独占的命名空间（如 pgsql.）按 key 的各级前缀查找。
+
+    Args:
+        keys: 内置 key 列表。
+        prefixes: 插件独占的命名空间列表。
+    """
+    def __init__(self, keys, prefixes=()):
+        self.keys = frozenset(keys)
+        self.prefixes = frozenset(p.rstrip(".") for p in prefixes)
+
+    def match(self, key):
+        key = key.split("[", 1)[0].strip()
+        if key in self.keys:
+            return True
+        if self.prefixes:
+            parts = key.split(".")
+            for i in range(1, len(parts)):
+                if ".".join(parts[:i]) in self.prefixes:
+                    return True
+        return False
+
+    def report(self, up_dict):
+        """一次遍历得到所有冲突的 key。
+
+        Args:
+            up_dict: {<up_path>: [<key1>, <key2> ...]}
+        Returns:
+            <dict>: {<up_path>: [<conflict_key1>, ...]}，只包含存在冲突的文件。
+        """
+        res = {}
+        for k, v in up_dict.items():
+            conflicts = [v_i for v_i in v if self.match(v_i)]
+            if conflicts:
+                res[k] = conflicts
+        return res
+
+CONFLICT_UP_MATCHER = BuiltinKeyMatcher(CONF_CONFLICT_UP, CONF_CONFLICT_UP_PREFIX)
+
+def expand_include(pattern, root=""):
+    """展开 Include 的值，支持单个文件、目录（包含其下所有文件）和通配符。
+
+    Args:
+        pattern: Include 的值。
+        root: 可选，主机配置快照的根目录，Include 的绝对路径相对于该目录展开。
+    Returns:
+        <list>: 文件路径列表。
+    """
+    if root:
+        pattern = os.path.join(root, pattern.lstrip("/"))
+    if os.path.isdir(pattern):
+        paths = [os.path.join(pattern, i) for i in os.listdir(pattern)]
+    else:
+        paths = glob.glob(pattern)
+    return sorted(i for i in paths if os.path.isfile(i))
+
+# Include 文件的扫描结果，{<绝对路径>: ((<inode>, <mtime>, <size>), <keys>, <nested>)}，文件未变时复用，
+# 由扫描线程和 invalidate_zbx_conf 在 _UP_SCAN_LOCK 下读写。
+_UP_SCAN_CACHE = {}
+_UP_SCAN_LOCK = threading.Lock()
+
+def scan_include_up(include_list, workers=INCLUDE_SCAN_WORKERS, root=""):
+    """使用有限的线程池并发、逐行地扫描 Include 文件中的 UserParameter，并跟随嵌套的 Include。
+
+    升级过程中冲突检查、Capacity 和审计会多次扫描相同的 Include 文件，未改变的文件复用上次的结果。
+
+    Args:
+        include_list: Include 的值列表。
+        workers: 扫描的线程数。
+        root: 可选，主机配置快照的根目录。
+    Returns:
+        <dict>: {<up_path>: [<key1>, <key2> ...]}
+        <dict>: {<up_path>: <扫描耗时秒数>}
+    """
+    res = {}
+    timings = {}
+    errors = []
+    lock = threading.Lock()
+    queue = Queue()
+
+    def submit(pattern):
+        for path in expand_include(pattern.strip(), root):
+            with lock:
+                if path in res:
+                    continue
+                res[path] = []
+            queue.put(path)
+
+    def worker():
+        while True:
+            path = queue.get()
+            if path is None:
+                queue.task_done()
+                return
+            try:
+                start = time.time()
+                st = os.stat(path)
+                stat_key = (st.st_ino, st.st_mtime, st.st_size)
+                cache_key = os.path.abspath(path)
+                with _UP_SCAN_LOCK:
+                    cached = _UP_SCAN_CACHE.get(cache_key)
+                if cached and cached[0] == stat_key:
+                    keys, nested = cached[1], cached[2]
+                else:
+                    keys = []
+                    nested = []
+                    for _, k, v in iter_zbx_conf(path):
+                        if k == "UserParameter":
+                            keys.append(v.split(",")[0].strip())
+                        elif k == "Include":
+                            nested.append(v)
+                    with _UP_SCAN_LOCK:
+                        _UP_SCAN_CACHE[cache_key] = (stat_key, keys, nested)
+                with lock:
+                    res[path] = list(keys)
+                    timings[path] = time.time() - start
+                for i in nested:
+                    submit(i)
+            except Exception as e:
+                with lock:
+                    errors.append((path, e))
+            finally:
+                queue.task_done()
+
+    for i in include_list:
+        submit(i)
+    threads = [threading.Thread(target=worker) for _ in range(max(1, int(workers)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    queue.join()
+    for _ in threads:
+        queue.put(None)
+    for t in threads:
+        t.join()
 
-def check_conflict_up(agent_conf_path):
+    if errors:
+        raise Exception("cannot scan the include file {!s}: {!s}".format(*errors[0]))
+    return res, timings
+
+def check_conflict_up(agent_conf_path, root=""):
     """检查是否存在有与 Zabbix-Agent2 内置的 key 冲突的 UP。
 
     Args:
         agent_conf_path: Zabbix-Agentd/2 的配置文件路径。
+        root: 可选，主机配置快照的根目录，Include 相对于该目录展开。
     Returns:
-        <bool>: 是否冲突。
+        <dict>: 冲突报告 {<up_path>: [<conflict_key1>, ...]}，无冲突时为空。
         <dict>: {<up_path>: [<key1>, <key2> ...]}
     """
     res = {}
     self_key = "@{!s}".format(agent_conf_path)
-    for i in parse_zbx_conf(agent_conf_path):
-        if i[0] == "UserParameter":
-            if self_key not in res:
-                res[self_key] = [i[1].split(",")[0].strip()]
-            else:
-                res[self_key].append(i[1].split(",")[0].strip())
-        if i[0] == "Include":
-            for j in glob.glob(i[1]):
-                res[j] = []
+    conf = load_zbx_conf(agent_conf_path)
+    for i in conf.get_all("UserParameter"):
+        res.setdefault(self_key, []).append(i.split(",")[0].strip())
+    include_res, timings = scan_include_up(conf.get_all("Include"), root=root)
+    res.update(include_res)
+    for k in sorted(timings, key=timings.get, reverse=True)[:10]:
+        logging.debug("scan include {!s} cost {:.3f}s".format(k, timings[k]))
 
-    for k in res:
-        if k == self_key:
-            continue
-        up_items = parse_zbx_conf(k, True)
-        for up in up_items:
-            if up[0] != "UserParameter":
-                continue
-            for entry in up[1].split("\n"):
-                res[k].append(entry.split(",")[0].strip())
+    return CONFLICT_UP_MATCHER.report(res), res
+
+def atomic_write(path, data):
+    """原子地写入文件：写入同目录下的临时文件并 fsync 后 rename 覆盖，保留原文件的权限和属主。
+    """
+    dir_path = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix="." + os.path.basename(path) + ".", dir=dir_path)
+    try:
+        with os.fdopen(fd, "w") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(path):
+            st = os.stat(path)
+            os.chmod(tmp_path, st.st_mode & 0o7777)
+            try:
+                os.chown(tmp_path, st.st_uid, st.st_gid)
+            except OSError:
+                pass
+        else:
+            os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    dir_fd = os.open(dir_path, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+class Journal(object):
+    """升级过程中改动的日志，每条记录追加写入并 fsync，回滚时逆序重放。
+
+    记录的类型（op）：
+        file_write: 文件被整体改写，backup 为原内容的备份路径，原文件不存在时为 None。
+        file_lines: 文件中的部分行被改写，changes 为 [{"line", "old", "new"}, ...]。
+        rpm: rpm 事务，在事务开始前记录，previous 为事务前已安装的包（rpm -q 的结果），未安装时为 None。
+        rpm_done: rpm 事务结束，intent 为对应 rpm 记录的 seq，ok 为事务是否成功。
+        service: 服务在改动前的状态，active 和 enabled。
+
+    Args:
+        path: 日志文件路径。
+        backup_dir: 备份目录。
+    """
+    def __init__(self, path, backup_dir):
+        self.path = path
+        self.backup_dir = backup_dir
+        for d in (os.path.dirname(path), backup_dir):
+            if d and not os.path.isdir(d):
+                os.makedirs(d)
+        self.seq = len(self.entries())
+
+    def entries(self):
+        if not os.path.isfile(self.path):
+            return []
+        res = []
+        with open(self.path, "r") as f:
+            for line in f:
+                try:
+                    res.append(json.loads(line))
+                except ValueError:
+                    # 写入中断的最后一行
+                    logging.warning("skip the broken journal line: {!s}".format(line.strip()))
+        return res
+
+    def record(self, op, **fields):
+        self.seq += 1
+        entry = {"seq": self.seq, "ts": round(time.time(), 6), "op": op}
+        entry.update(fields)
+        with open(self.path, "a") as f:
+            f.write(json.dumps(entry, sort_keys=True) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        return entry
+
+    def backup(self, path):
+        if not os.path.isfile(path):
+            return None
+        backup_path = os.path.join(self.backup_dir, "{:06d}-{!s}".format(self.seq + 1, os.path.basename(path)))
+        shutil.copy2(path, backup_path)
+        return backup_path
+
+    def archive(self):
+        if os.path.isfile(self.path):
+            os.rename(self.path, "{!s}.{!s}.done".format(self.path, int(time.time())))
 
-    for v in res.values():
-        for v_i in v:
-            if v_i in CONF_CONFLICT_UP:
-                return True, res
+_JOURNAL = None
 
-    return False, res
+def init_journal(path=JOURNAL_PATH, backup_dir=JOURNAL_BACKUP_DIR):
+    """开启改动日志，之后的配置改写、rpm 事务和服务状态变更都会被记录，为空则关闭。
+    """
+    global _JOURNAL
+    _JOURNAL = Journal(path, backup_dir) if path else None
+    return _JOURNAL
+
+def journal_record(op, **fields):
+    if _JOURNAL is not None:
+        return _JOURNAL.record(op, **fields)
+
+def journal_write_file(path, data):
+    """记录改动后原子地改写文件。
+    """
+    if _JOURNAL is not None:
+        _JOURNAL.record("file_write", path=path, backup=_JOURNAL.backup(path))
+    atomic_write(path, data)
+    invalidate_zbx_conf(path)
+
+def service_is_active(service):
+    return run_command(["systemctl", "is-active", service], timeout=30, log_level=None).returncode == 0
+
+def journal_services(services):
+    """记录服务在改动前的状态。
+    """
+    if _JOURNAL is None:
+        return
+    for service in services:
+        active = service_is_active(service)
+        enabled = run_command(["systemctl", "is-enabled", service], timeout=30, log_level=None).returncode == 0
+        _JOURNAL.record("service", service=service, active=active, enabled=enabled)
+
+def deal_conflict_up(conflict_dict):
+    """注释掉冲突的 UserParameter 行，每个文件只读写一次，改动记录于改动日志以便回滚。
+
+    Args:
+        conflict_dict: check_conflict_up 返回的冲突报告，{<up_path>: [<conflict_key1>, ...]}，
+            主配置文件的 up_path 以 "@" 开头。
+    Returns:
+        <dict>: 本次的改动，{<path>: [{"line": <行号>, "old": <原始行>, "new": <改写后的行>}, ...]}
+    """
+    res = {}
+    for k in sorted(conflict_dict):
+        conf_path = k[1:] if k.startswith("@") else k
+        changes = disable_up_lines(conf_path, conflict_dict[k], CONFLICT_LINE_PREFIX)
+        if changes:
+            res[conf_path] = changes
+    return res
+
+def disable_up_lines(conf_path, keys, prefix):
+    """以前缀注释掉文件中指定 key 的 UserParameter 行，只读写一次，改动记录于改动日志。
 
-def get_include_up(agent_conf_path):
+    Args:
+        conf_path: 配置文件路径。
+        keys: UserParameter 的 key 列表。
+        prefix: 注释的前缀，回滚时据此恢复。
+    Returns:
+        <list>: [{"line": <行号>, "old": <原始行>, "new": <改写后的行>}, ...]
     """
+    keys = set(keys)
+    with open(conf_path, "r") as f:
+        line_list = f.readlines()
+    changes = []
+    for idx, line in enumerate(line_list):
+        item = tokenize_zbx_line(line)
+        if not item or item[0] != "UserParameter":
+            continue
+        if item[1].split(",")[0].strip() not in keys:
+            continue
+        line_list[idx] = prefix + line
+        changes.append({"line": idx + 1, "old": line, "new": line_list[idx]})
+        logging.info("disable UserParameter on {!s}:{!s}: {!s}".format(conf_path, idx + 1, line.strip()))
+    if changes:
+        journal_record("file_lines", path=conf_path, changes=changes)
+        atomic_write(conf_path, "".join(line_list))
+        invalidate_zbx_conf(conf_path)
+    return changes
+
+_UP_REWRITE_RULES = [(re.compile(r"\s*" + r + r"\s*$"), key, exact) for r, key, exact in UP_REWRITE_RULES]
+
+def count_up_forks(command):
+    """估算 UserParameter 每次采集 fork 的进程数：agent 的 sh -c，加上命令中每个非内建的简单命令。
     """
-    res = set()
-    for i in parse_zbx_conf(agent_conf_path):
-        if i[0] == "Include":
-            res.add(i[1].strip())
+    res = 1
+    for segment in re.split(r"\|\|?|&&|;|\$\(|`", command):
+        words = [i for i in segment.split() if not re.match(r"^\w+=", i)]
+        if words and words[0].strip("()") not in SHELL_BUILTINS:
+            res += 1
     return res
 
-def deal_conflict_up(up_dict):
+def classify_up_command(key, command):
+    """判断 UserParameter 能否由 agent2 的内置 key 代替。
+
+    带参数的 UserParameter（key[*]）中的 $1 等会被 agent 替换，不做判断。
+
+    Args:
+        key: UserParameter 的 key。
+        command: UserParameter 的命令。
+    Returns:
+        <str>: 内置 key，不能代替时为 None。
+        <bool>: 是否可直接改写。
     """
+    if "[" in key:
+        return None, False
+    for pattern, native_key, exact in _UP_REWRITE_RULES:
+        m = pattern.match(command)
+        if m:
+            return native_key.format(*m.groups()), exact
+    return None, False
+
+def audit_up(agent_conf_path, intervals=None):
+    """评估配置（含 Include）中每个 UserParameter 的 fork 开销，以及能否改写为 agent2 的内置 key。
+
+    Args:
+        agent_conf_path: Zabbix-Agentd/2 的配置文件路径。
+        intervals: 可选，各 key 的采集间隔秒数 {<key>: <秒数>}，未知的使用 UP_AUDIT_DEFAULT_INTERVAL。
+    Returns:
+        <OrderedDict>: 审计报告，items 中 action 为 rewrite（可直接改写）、propose（建议改写）、
+            conflict（与内置 key 冲突）或 keep。
     """
-    for k, v in up_dict.items():
-        has_deal = False
-        for v_i in v:
-            if has_deal:
-                break
-            if v_i in CONF_CONFLICT_UP:
-                if k.startswith("@"):
-                    conf_path = k.split("@")[-1].strip()
-                    context_list = []
-                    with open(conf_path, "r") as f:
-                        original_list = [l for l in f]
-                    for line in original_list:
-                        if re.search(r"^\s*UserParameter\s*=\s*{!s}\s*,.*?$".format(v_i), line):
-                            logging.info("deal with conflict UserParameter on self config: {!s}".format(line.strip()))
-                            continue
-                        context_list.append(line)
-                    with open(conf_path, "w") as f:
-                        for line in context_list:
-                            f.write(line)
+    intervals = intervals or {}
+    _, up_dict = check_conflict_up(agent_conf_path)
+    items = []
+    for k in sorted(up_dict):
+        path = k[1:] if k.startswith("@") else k
+        with open(path, "r") as f:
+            for lineno, line in enumerate(f, 1):
+                # 之前已改写的行依然列出，以便重复执行时保留其 Alias
+                if line.startswith(UP_REWRITE_LINE_PREFIX):
+                    line = line[len(UP_REWRITE_LINE_PREFIX):]
+                item = tokenize_zbx_line(line)
+                if not item or item[0] != "UserParameter" or "," not in item[1]:
+                    continue
+                key, command = [i.strip() for i in item[1].split(",", 1)]
+                interval = float(intervals.get(key) or intervals.get(key.split("[", 1)[0]) or UP_AUDIT_DEFAULT_INTERVAL)
+                native_key, exact = classify_up_command(key, command)
+                if CONFLICT_UP_MATCHER.match(key):
+                    action = "conflict"
+                elif native_key:
+                    action = "rewrite" if exact else "propose"
                 else:
-                    # 直接整个文件关闭匹配
-                    conf_dir = os.path.dirname(k)
-                    conf_name = os.path.basename(k)
-                    disable_path = os.path.join(conf_dir, conf_name + CONFLICT_SUFFIX)
-                    shutil.move(k, disable_path)
-                    logging.info("deal with conflict UserParameter on outer config: {!s} -> {!s}".format(k, disable_path))
-                    has_deal = True
-                    break
+                    action = "keep"
+                forks = count_up_forks(command)
+                item = OrderedDict()
+                item["path"] = path
+                item["line"] = lineno
+                item["key"] = key
+                item["command"] = command
+                item["native_key"] = native_key
+                item["action"] = action
+                item["forks_per_poll"] = forks
+                item["interval"] = interval
+                item["forks_per_min"] = round(forks * 60 / interval, 3)
+                items.append(item)
 
-def rollback_conflict_up(conf_path):
-    up_dir_set = get_include_up(conf_path)
-    for d in up_dir_set:
-        for f in glob.glob(d + CONFLICT_SUFFIX):
-            if not os.path.isfile(f):
-                continue
-            conf_dir = os.path.dirname(f)
-            conf_name = os.path.basename(f)
-            enable_path = os.path.join(conf_dir, "".join(conf_name.split(CONFLICT_SUFFIX)[:-1]))
-            shutil.move(f, enable_path)
-            logging.info("deal with conflict UserParameter on outer config: {!s} -> {!s}".format(f, enable_path))
+    res = OrderedDict()
+    res["host"] = platform.node()
+    res["conf"] = agent_conf_path
+    res["userparameter_count"] = len(items)
+    res["forks_per_min"] = round(sum(i["forks_per_min"] for i in items), 3)
+    for action in ("rewrite", "propose", "conflict"):
+        res["{!s}_forks_per_min".format(action)] = round(
+            sum(i["forks_per_min"] for i in items if i["action"] == action), 3)
+    res["items"] = items
+    return res
+
+def apply_up_rewrite(audit, agent2_conf_path):
+    """将审计报告中可直接改写的 UserParameter 注释掉，并在 agent2 配置中以 Alias 指向等价的内置 key。
+
+    Args:
+        audit: audit_up 的审计报告。
+        agent2_conf_path: agent2 的配置文件路径。
+    Returns:
+        <float>: 消除的每分钟 fork 数。
+    """
+    by_path = OrderedDict()
+    aliases = OrderedDict()
+    for i in audit["items"]:
+        if i["action"] != "rewrite":
+            continue
+        by_path.setdefault(i["path"], []).append(i["key"])
+        aliases.setdefault(i["key"], i["native_key"])
+    if not aliases:
+        return 0
+    for path, keys in by_path.items():
+        disable_up_lines(path, keys, UP_REWRITE_LINE_PREFIX)
+
+    with open(agent2_conf_path, "r") as f:
+        content = f.read()
+    if content and not content.endswith("\n"):
+        content += "\n"
+    for k, v in aliases.items():
+        logging.info("rewrite UserParameter {!s} to Alias of {!s}".format(k, v))
+        content += "Alias={!s}:{!s}\n".format(k, v)
+    journal_write_file(agent2_conf_path, content)
+    return audit["rewrite_forks_per_min"]
+
+def rewrite_conf_lines(line_list, update_items, add_items, ignore_items, remove_items=(), ordered_items=()):
+    """一次遍历配置文件的行，完成更新项的替换、删除项的移除和新增项的插入。
+
+    更新项替换所有同名的生效行；删除项移除 key 和 value 都相同的生效行；
+    新增项插入到第一个同名的注释模板行（如 "# Timeout=3"）之后，
+    没有模板行的追加到文件末尾，同名的多个新增项保持原有顺序。
+    有序项不为空时替换所有 CONF_ORDERED_ITEMS 的生效行，按给出的顺序整体写在第一条生效行的位置，
+    没有生效行时写在第一个模板行之后，都没有的追加到文件末尾。
+
+    Args:
+        line_list: 配置文件的原始行。
+        update_items: 需更新的补齐。
+        add_items: 需增加的补齐。
+        ignore_items: 忽略的配置项。
+        remove_items: 可选，需删除的 (<key>, <value>)。
+        ordered_items: 可选，ConfDiff 的 ordered_items。
+    Returns:
+        <list>: 改写后的行。
+    """
+    removes = set((k, v) for k, v in remove_items if k not in ignore_items)
+    ignore_items = set(ignore_items)
+    ordered = set(CONF_ORDERED_ITEMS)
+    ordered_lines = ["{!s} = {!s}\n".format(k, v) for k, v in ordered_items if k not in ignore_items]
+    replace_ordered = bool(ordered_lines)
+    # 有生效行时写在第一条生效行的位置，否则写在模板行之后
+    ordered_in_place = replace_ordered and any(
+        (tokenize_zbx_line(line) or ("",))[0] in ordered for line in line_list)
+    updates = {}
+    for k, v in update_items:
+        if k not in ignore_items:
+            updates.setdefault(k, v)
+    adds = OrderedDict()
+    for k, v in add_items:
+        if k not in ignore_items:
+            adds.setdefault(k, []).append(v)
+
+    res = []
+    for line in line_list:
+        item = tokenize_zbx_line(line)
+        if replace_ordered and item and item[0] in ordered:
+            if ordered_in_place:
+                logging.info("for ordered items, rewrite at line {!s}".format(len(res) + 1))
+                res.extend(ordered_lines)
+                ordered_in_place = False
+                ordered_lines = []
+            continue
+        if item in removes:
+            logging.info("remove items on agnet2: {!s} = {!s}".format(*item))
+            continue
+        if item and item[0] in updates:
+            k = item[0]
+            logging.info("update items on agnet2: {!s} = {!s} -> {!s}".format(k, item[1], updates[k]))
+            line = "{!s} = {!s}\n".format(k, updates[k])
+        res.append(line)
+        if not adds and not ordered_lines:
+            continue
+        m = _CONF_TEMPLATE_RE.match(line)
+        if m and ordered_lines and not ordered_in_place and m.group(1) in ordered:
+            logging.info("for ordered items, insert to line {!s}".format(len(res)))
+            res.extend(ordered_lines)
+            ordered_lines = []
+        if m and m.group(1) in adds:
+            k = m.group(1)
+            logging.info("for item {!s}, insert to line {!s}".format(k, len(res)))
+            for v in adds.pop(k):
+                res.append("{!s} = {!s}\n".format(k, v))
+
+    for k, values in adds.items():
+        logging.info("for item {!s}, append for tail".format(k))
+        for v in values:
+            if res and not res[-1].endswith("\n"):
+                res[-1] += "\n"
+            res.append("{!s} = {!s}\n".format(k, v))
+    if ordered_lines:
+        logging.info("for ordered items, append for tail")
+        if res and not res[-1].endswith("\n"):
+            res[-1] += "\n"
+        res.extend(ordered_lines)
+    return res
 
-def update_diff_conf(path, update_items, add_items, ignore_items):
+def update_diff_conf(path, update_items, add_items, ignore_items, ordered_items=()):
     """将差异的 conf 文件内容补齐。
 
     Args:
         path: 需补齐的配置文件路径。
         update_items: 需更新的补齐。
         add_items: 需增加的补齐。
+        ignore_items: 忽略的配置项。
+        ordered_items: 可选，需按顺序整体替换的 CONF_ORDERED_ITEMS 项。
     """
-    line_list = []
     with open(path, "r") as f:
-        original_list = [l for l in f]
-    tmp_line_list = [l for l in original_list]
-
-    logging.debug("dealing with update_items ......")
-    for l in tmp_line_list:
-        line = l
-        for i in update_items:
-            if i[0] in ignore_items:
-                continue
-            tmp_re = re.search(r"^\s*{!s}\s*=\s*(.*?)\s*$".format(i[0]), l)
-            if tmp_re:
-                logging.info("update items on agnet2: {!s} = {!s} -> {!s}".format(
-                    i[0],
-                    tmp_re.group(1),
-                    i[1]))
-                line = "{!s} = {!s}\n".format(i[0], i[1])
-                break
-        line_list.append(line)
+        original_list = f.readlines()
 
-    logging.debug("dealing with add_items ......")
-    for i in add_items:
-        if i[0] in ignore_items:
-            continue
-        i_idx = -1
-        for l_idx in range(len(line_list)):
-            if re.search(r"^\s*#\s*{!s}\s*=.*?$".format(i[0]), line_list[l_idx]):
-                i_idx = l_idx
-                break
-        if i_idx < 0:
-            logging.info("for item {!s}, append for tail".format(i[0]))
-            if line_list[-1][-1] == "\n":
-                line_list.append("{!s} = {!s}\n".format(i[0], i[1]))
-            else:
-                line_list.append("\n{!s} = {!s}\n".format(i[0], i[1]))
-        else:
-            logging.info("for item {!s}, insert to line {!s}".format(i[0], str(i_idx+1)))
-            line_list = line_list[:i_idx+1] + ["{!s} = {!s}\n".format(i[0], i[1]),] + line_list[i_idx+1:]
+    logging.debug("dealing with update_items and add_items ......")
+    line_list = rewrite_conf_lines(original_list, update_items, add_items, ignore_items, ordered_items=ordered_items)
 
     # bacup(options)
     path_bak = path + CONF_BACKUP_SUFFIX
-    with open(path_bak, "w") as f:
-        for line in original_list:
-            f.write(line)
+    journal_write_file(path_bak, "".join(original_list))
 
-    with open(path, "w") as f:
-        for line in line_list:
-            f.write(line)
+    journal_write_file(path, "".join(line_list))
 
-def systemctl_action(action, service):
-    """
+def systemctl_action(action, service, now=False):
+    """执行 systemctl 操作。
+
+    Args:
+        action: systemctl 的操作。
+        service: 服务名。
+        now: 是否在 enable/disable 的同时 start/stop 服务（--now），减少一次进程调用。
     """
     if action not in ("start", "stop", "restart", "status", "enable", "disable"):
         raise Exception("not support the systemctl action: {!s}".format(action))
-    command_lst = ["systemctl", action, service]
-    if lnx_command_execute(command_lst):
+    if now and action not in ("enable", "disable"):
+        raise Exception("not support --now with the systemctl action: {!s}".format(action))
+    command_lst = ["systemctl", action] + (["--now"] if now else []) + [service]
+    start = time.time()
+    ok = lnx_command_execute(command_lst)
+    emit_event("systemctl", action=action, service=service, now=now, duration=round(time.time() - start, 6), ok=ok)
+    if ok:
         logging.debug("systemctl action is successful")
         return True
     else:
         logging.debug("systemctl action is failed")
         return False
 
+def zbx_passive_get(host, port, key, timeout=3):
+    """以 Zabbix 被动检查协议向 agent 获取一个 key 的值。
+
+    Args:
+        host: agent 地址。
+        port: agent 端口。
+        key: 监控项的 key。
+        timeout: 超时秒数。
+    Returns:
+        <str>: 返回的值，agent 接受连接但拒绝请求（如 Server 不包含本机）时为空字符串。
+    """
+    sock = socket.create_connection((host, int(port)), timeout)
+    try:
+        sock.sendall(b"ZBXD\x01" + struct.pack("<Q", len(key)) + key)
+        chunks = []
+        for chunk in iter(lambda: sock.recv(4096), b""):
+            chunks.append(chunk)
+    finally:
+        sock.close()
+    resp = b"".join(chunks)
+    if resp.startswith(b"ZBXD") and len(resp) >= 13:
+        length = struct.unpack("<Q", resp[5:13])[0]
+        return resp[13:13+length]
+    return resp
+
+def get_agent_listen(conf_path):
+    """从 agent 配置中获取本机可访问的监听地址和端口。
+
+    Returns:
+        <str>: 监听地址，监听全部地址时为 127.0.0.1。
+        <int>: 监听端口。
+    """
+    host, port = "127.0.0.1", 10050
+    if os.path.isfile(conf_path):
+        conf = load_zbx_conf(conf_path)
+        listen_ip = conf.get("ListenIP", "").split(",")[0].strip()
+        if listen_ip and listen_ip not in ("0.0.0.0", "::"):
+            host = listen_ip
+        port = int(conf.get("ListenPort", port))
+    return host, port
+
+def wait_agent_ready(host="127.0.0.1", port=10050, timeout=AGENT_READY_TIMEOUT):
+    """以指数退避的间隔轮询 agent.ping，直到 agent 在监听端口上响应或超时。
+
+    Args:
+        host: agent 地址。
+        port: agent 端口。
+        timeout: 最长等待秒数。
+    Returns:
+        <float>: 从开始轮询到 agent 响应的秒数，超时返回 None。
+    """
+    start = time.time()
+    interval = AGENT_READY_INTERVAL
+    while True:
+        try:
+            value = zbx_passive_get(host, port, "agent.ping", max(0.1, min(3, timeout)))
+        except (socket.error, socket.timeout):
+            pass
+        else:
+            elapsed = time.time() - start
+            if value.strip() != "1":
+                logging.warning("agent on {!s}:{!s} accepts the connection but agent.ping returns {!r}, "
+                    "please check the Server param".format(host, port, value))
+            logging.info("agent on {!s}:{!s} is ready after {:.3f}s".format(host, port, elapsed))
+            emit_event("ready", port=port, duration=round(elapsed, 6), ok=True)
+            return elapsed
+        remain = timeout - (time.time() - start)
+        if remain <= 0:
+            logging.error("agent on {!s}:{!s} is not ready after {!s}s".format(host, port, timeout))
+            return None
+        time.sleep(min(interval, remain))
+        interval = min(interval * 2, AGENT_READY_MAX_INTERVAL)
+
+def parity_keys(agentd_conf_path, extra_keys=None):
+    """切换前后需要对比的 key：agentd 中不带参数的 UserParameter（含改写为 Alias 和与内置 key 冲突的），
+    PARITY_BUILTIN_KEYS 以及额外指定的 key。
+    """
+    keys = OrderedDict()
+    if agentd_conf_path and os.path.isfile(agentd_conf_path):
+        _, up_dict = check_conflict_up(agentd_conf_path)
+        for k in sorted(up_dict):
+            for key in up_dict[k]:
+                if "[" not in key:
+                    keys[key] = None
+    for key in PARITY_BUILTIN_KEYS + list(extra_keys or []):
+        keys[key.strip()] = None
+    return [i for i in keys if i]
+
+def parity_sample(host, port, keys, samples=PARITY_SAMPLES, workers=PARITY_WORKERS, timeout=PARITY_TIMEOUT):
+    """以有限的并发连接对每个 key 采样若干次，记录返回值和每次的延迟。
+
+    Args:
+        host: agent 地址。
+        port: agent 端口。
+        keys: key 列表。
+        samples: 每个 key 的采样次数。
+        workers: 并发连接数。
+        timeout: 单次请求的超时秒数。
+    Returns:
+        <OrderedDict>: {<key>: {"value": <首个返回值>, "supported": <bool>, "latencies": [<秒数>, ...], "errors": <失败次数>}}
+    """
+    res = OrderedDict((k, {"value": None, "supported": False, "latencies": [], "errors": 0}) for k in keys)
+    lock = threading.Lock()
+    queue = Queue()
+    for _ in range(samples):
+        for k in keys:
+            queue.put(k)
+
+    def worker():
+        while True:
+            try:
+                key = queue.get_nowait()
+            except Empty:
+                return
+            start = time.time()
+            try:
+                value = zbx_passive_get(host, port, key, timeout)
+            except (socket.error, socket.timeout) as e:
+                logging.debug("get {!s} from {!s}:{!s} is failed: {!s}".format(key, host, port, e))
+                with lock:
+                    res[key]["errors"] += 1
+                continue
+            elapsed = time.time() - start
+            with lock:
+                item = res[key]
+                item["latencies"].append(round(elapsed, 6))
+                if item["value"] is None:
+                    item["value"] = value.split(b"\0", 1)[0].strip().decode("utf-8", "replace")
+                    item["supported"] = not item["value"].startswith("ZBX_NOTSUPPORTED")
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, int(workers)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    for item in res.values():
+        item["latencies"].sort()
+    return res
+
+def parity_value_equal(key, before, after):
+    """按 key 的特点比较两个返回值：随时间变化的 key 只比较是否都支持，数值允许 PARITY_NUMERIC_TOLERANCE 的相对误差。
+    """
+    base = key.split("[", 1)[0]
+    if base in PARITY_VOLATILE_KEYS:
+        return True
+    if before == after:
+        return True
+    try:
+        b, a = float(before), float(after)
+    except (TypeError, ValueError):
+        return False
+    return abs(a - b) <= PARITY_NUMERIC_TOLERANCE * max(abs(a), abs(b))
+
+def parity_compare(before, after):
+    """对比两次采样，标记返回值不一致、不再支持、无法获取和延迟回退的 key。
+
+    Args:
+        before: 切换前的 parity_sample 结果。
+        after: 切换后的 parity_sample 结果。
+    Returns:
+        <OrderedDict>: 对比报告。
+    """
+    items = OrderedDict()
+    regressions = []
+    for key in before:
+        b = before[key]
+        a = after.get(key) or {"value": None, "supported": False, "latencies": [], "errors": 0}
+        item = OrderedDict()
+        item["before"] = b["value"]
+        item["after"] = a["value"]
+        item["before_p50"] = percentile(b["latencies"], 50)
+        item["before_p95"] = percentile(b["latencies"], 95)
+        item["after_p50"] = percentile(a["latencies"], 50)
+        item["after_p95"] = percentile(a["latencies"], 95)
+        reasons = []
+        # 切换前就无法获取的 key 不比较返回值
+        if b["value"] is not None:
+            if a["value"] is None:
+                reasons.append("unreachable")
+            elif b["supported"] and not a["supported"]:
+                reasons.append("unsupported")
+            elif b["supported"] and not parity_value_equal(key, b["value"], a["value"]):
+                reasons.append("value")
+        if item["before_p50"] is not None and item["after_p50"] is not None and \
+                item["after_p50"] > item["before_p50"] * (1 + PARITY_LATENCY_TOLERANCE) and \
+                item["after_p50"] - item["before_p50"] > PARITY_LATENCY_MIN_DELTA:
+            reasons.append("latency")
+        item["regressions"] = reasons
+        items[key] = item
+        if reasons:
+            regressions.append(key)
+            logging.warning("parity regression on {!s}: {!s}, value {!r} -> {!r}, p50 {!s} -> {!s}".format(
+                key, ",".join(reasons), item["before"], item["after"], item["before_p50"], item["after_p50"]))
+
+    def p50_of(sample):
+        return percentile(sorted(i for v in sample.values() for i in v["latencies"]), 50)
+
+    res = OrderedDict()
+    res["keys"] = len(items)
+    res["regressions"] = regressions
+    res["before_p50"] = p50_of(before)
+    res["after_p50"] = p50_of(after)
+    res["items"] = items
+    return res
+
+def parity_agents(before_listen, after_listen, keys):
+    """对两个 agent 依次采样并对比，可以是本机的两个 agent，也可以是替身的监听。
+
+    Args:
+        before_listen: 基准 agent 的 (<host>, <port>)。
+        after_listen: 对比的 agent 的 (<host>, <port>)。
+        keys: key 列表。
+    Returns:
+        <OrderedDict>: parity_compare 的对比报告。
+    """
+    with phase_timer("parity.before"):
+        before = parity_sample(before_listen[0], before_listen[1], keys)
+    with phase_timer("parity.after"):
+        after = parity_sample(after_listen[0], after_listen[1], keys)
+    return parity_report(parity_compare(before, after))
+
+def parity_save_baseline(agentd_conf_path, extra_keys=None, path=PARITY_BASELINE_PATH):
+    """切换前对运行中的 agentd 采样，保存为对比的基准。
+    """
+    keys = parity_keys(agentd_conf_path, extra_keys)
+    sample = parity_sample(*get_agent_listen(agentd_conf_path), keys=keys)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    atomic_write(path, json.dumps({"ts": round(time.time(), 6), "sample": sample}))
+    logging.info("parity baseline of {!s} keys is saved to {!s}".format(len(keys), path))
+
+def parity_check_agent2(agent2_conf_path, path=PARITY_BASELINE_PATH):
+    """切换后对 agent2 采样，与切换前 agentd 的基准对比。
+
+    Returns:
+        <OrderedDict>: 对比报告，没有基准时为 None。
+    """
+    if not os.path.isfile(path):
+        logging.warning("not found the parity baseline {!s}, skip the parity check".format(path))
+        return None
+    with open(path, "r") as f:
+        before = json.load(f, object_pairs_hook=OrderedDict)["sample"]
+    after = parity_sample(*get_agent_listen(agent2_conf_path), keys=list(before))
+    return parity_report(parity_compare(before, after))
+
+def parity_report(report):
+    logging.info("parity on {!s} keys, {!s} regressions, p50 {!s} -> {!s}".format(
+        report["keys"], len(report["regressions"]), report["before_p50"], report["after_p50"]))
+    emit_event("parity", keys=report["keys"], regressions=report["regressions"],
+        before_p50=report["before_p50"], after_p50=report["after_p50"])
+    return report
+
 def get_sysversion():
     """获取当前操作系统的版本信息。
 
@@ -342,53 +1502,529 @@ def get_sysversion():
             logging.error("Cannot get sysversion from [{!s}].".format(res_tmp))
             raise Exception()
 
-def url_test(url, timeout=5):
-    """测试 url 是否在超时范围内可达。
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024*1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
 
-    Args:
-        url: 测试 URL。
-        timeout: 超时秒数。
-    Returns:
-        <bool>: 测试通过与否。
+def content_range_total(value):
+    """返回 Content-Range（如 "bytes 0-99/200" 或 "bytes */200"）中的总大小，未知时为 None。
     """
-    from urllib2 import urlopen, URLError
-    try:
-        urlopen(url, timeout = int(timeout))
-    except Exception as e:
+    m = re.match(r"bytes\s+(?:\d+-\d+|\*)/(\d+)", value or "")
+    return int(m.group(1)) if m else None
+
+def download_url(url, path, timeout=RPM_DOWNLOAD_TIMEOUT, retry=RPM_DOWNLOAD_RETRY, sha256=None):
+    """流式下载 url 到 path，中断后基于已下载的部分通过 Range 续传。
+
+    服务端的 ETag/Last-Modified 记录于 path + ".meta"，续传时以 If-Range 确认文件未变化，文件已变化时
+    服务端返回完整内容并从头写入；没有记录且未给出 sha256 时不续传，从头下载，避免把变化后的文件接在
+    旧的内容之后。下载的完整性按 Content-Range 或 Content-Length 给出的总大小判断，416 时已下载的部分
+    须与总大小或 sha256 一致，否则同样从头下载。
+
+    Args:
+        url: 下载 URL。
+        path: 保存路径，已存在的内容视为已下载的部分。
+        timeout: 连接和读取的超时秒数。
+        retry: 最多尝试次数。
+        sha256: 可选，文件的 sha256，由调用方在下载后校验，给出时没有 ETag/Last-Modified 也可以续传。
+    Returns:
+        <dict>: 服务端的 ETag 和 Last-Modified，以及是否确认了下载的完整性，
+            {"etag": ..., "last_modified": ..., "verified": <bool>}。
+    """
+    from urllib2 import urlopen, Request
+    meta_path = path + ".meta"
+    meta = {}
+    if os.path.isfile(meta_path):
+        with open(meta_path, "r") as f:
+            try:
+                meta = json.load(f)
+            except ValueError:
+                meta = {}
+    for attempt in range(1, retry + 1):
+        offset = os.path.getsize(path) if os.path.isfile(path) else 0
+        etag = meta.get("etag")
+        # 弱 ETag 不能用于 If-Range
+        validator = etag if etag and not etag.startswith("W/") else meta.get("last_modified")
+        if offset and not validator and not sha256:
+            logging.info("cannot validate the partial {!s}, download it again".format(path))
+            offset = 0
+        req = Request(url)
+        if offset:
+            req.add_header("Range", "bytes={!s}-".format(offset))
+            if validator:
+                req.add_header("If-Range", validator)
+        try:
+            resp = urlopen(req, timeout = int(timeout))
+            info = resp.info()
+            if offset and resp.getcode() != 206:
+                # 文件已变化或服务端不支持 Range，返回的是完整内容
+                offset = 0
+            meta = {"etag": info.getheader("ETag"), "last_modified": info.getheader("Last-Modified")}
+            with open(meta_path, "w") as f:
+                json.dump(meta, f)
+            total = content_range_total(info.getheader("Content-Range")) if offset else None
+            length = info.getheader("Content-Length")
+            if total is None and length is not None:
+                total = offset + int(length)
+            with open(path, "ab" if offset else "wb") as f:
+                for chunk in iter(lambda: resp.read(64*1024), b""):
+                    f.write(chunk)
+            size = os.path.getsize(path)
+            if total is not None and size != total:
+                raise Exception("received {!s} of {!s} bytes".format(size, total))
+            # chunked 的响应被截断时 httplib 会抛出 IncompleteRead
+            meta["verified"] = total is not None or info.getheader("Transfer-Encoding") == "chunked"
+            if not meta["verified"]:
+                logging.warning("the size of {!s} is unknown, the download cannot be verified".format(url))
+            os.remove(meta_path)
+            return meta
+        except Exception as e:
+            if getattr(e, "code", None) == 416:
+                # 已下载的部分不少于远程文件，确认与远程文件一致才视为完成
+                total = content_range_total(e.info().getheader("Content-Range"))
+                if offset == total or (sha256 and file_sha256(path) == sha256.lower()):
+                    if os.path.isfile(meta_path):
+                        os.remove(meta_path)
+                    meta["verified"] = True
+                    return meta
+                logging.warning("the partial {!s} does not match {!s}, download it again".format(path, url))
+                os.remove(path)
+                continue
+            logging.warning("download {!s} is interrupted ({!s}/{!s}): {!s}".format(url, attempt, retry, e))
+    raise Exception("cannot download the rpm url: {!s}".format(url))
+
+def revalidate_url(url, validators, timeout=RPM_DOWNLOAD_TIMEOUT):
+    """以条件请求（If-None-Match/If-Modified-Since）确认 url 的内容与上次下载时相同。
+
+    Args:
+        url: 下载 URL。
+        validators: 上次下载时服务端的 ETag 和 Last-Modified，{"etag": ..., "last_modified": ...}。
+        timeout: 连接和读取的超时秒数。
+    Returns:
+        <bool>: 服务端返回 304 时为 True，没有 ETag/Last-Modified、内容已变化或请求失败时为 False。
+    """
+    from urllib2 import urlopen, Request, HTTPError
+    if not validators.get("etag") and not validators.get("last_modified"):
         return False
-    else:
-        return True
+    req = Request(url)
+    if validators.get("etag"):
+        req.add_header("If-None-Match", validators["etag"])
+    if validators.get("last_modified"):
+        req.add_header("If-Modified-Since", validators["last_modified"])
+    try:
+        urlopen(req, timeout = int(timeout)).close()
+    except HTTPError as e:
+        return e.code == 304
+    except Exception as e:
+        logging.warning("cannot revalidate {!s}: {!s}".format(url, e))
+    return False
+
+def fetch_rpm(url, sha256=None, cache_dir=RPM_CACHE_DIR):
+    """获取 rpm 包的本地路径，远程的包只下载一次并按 sha256 缓存于 cache_dir。
+
+    给出 sha256 时直接按 sha256 查找缓存；否则按 index.json 中记录的该 URL 上次下载的 sha256 查找，
+    且须以条件请求确认服务端的文件未变化，变化后重新下载。
 
-def remove_item_pair_value(items, k):
+    Args:
+        url: 安装包的 URL 或本地路径。
+        sha256: 可选，安装包的 sha256，校验失败则抛出异常。
+        cache_dir: 缓存目录。
+    Returns:
+        <str>: 本地的 rpm 文件路径。
     """
+    from urlparse import urlparse
+    parsed = urlparse(url)
+    if parsed.scheme in ("", "file"):
+        path = parsed.path
+        if sha256 and file_sha256(path) != sha256.lower():
+            raise Exception("the sha256 of {!s} is not matched".format(path))
+        return path
+
+    name = os.path.basename(parsed.path) or "zabbix-agent2.rpm"
+    index_path = os.path.join(cache_dir, "index.json")
+    index = {}
+    if os.path.isfile(index_path):
+        with open(index_path, "r") as f:
+            index = json.load(f)
+    expected = (sha256 or "").lower()
+    entry = index.get(url)
+    if not expected and entry and revalidate_url(url, entry):
+        expected = entry["sha256"]
+    if expected:
+        cache_path = os.path.join(cache_dir, expected, name)
+        if os.path.isfile(cache_path) and file_sha256(cache_path) == expected:
+            logging.info("use the cached rpm {!s}".format(cache_path))
+            return cache_path
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    part_path = os.path.join(cache_dir, hashlib.sha256(url).hexdigest() + ".part")
+    start = time.time()
+    meta = download_url(url, part_path, sha256=sha256)
+    actual = file_sha256(part_path)
+    logging.info("download {!s} cost {:.3f}s, sha256: {!s}".format(url, time.time() - start, actual))
+    if sha256 and actual != sha256.lower():
+        os.remove(part_path)
+        raise Exception("the sha256 of {!s} is not matched: {!s}".format(url, actual))
+    # 无法确认完整性时以 rpm 包自带的摘要检查是否被截断
+    if not sha256 and not meta["verified"] and not lnx_command_execute(["rpm", "-K", "--nosignature", part_path]):
+        os.remove(part_path)
+        raise Exception("the rpm downloaded from {!s} is broken".format(url))
+
+    cache_path = os.path.join(cache_dir, actual, name)
+    if not os.path.isdir(os.path.dirname(cache_path)):
+        os.makedirs(os.path.dirname(cache_path))
+    os.rename(part_path, cache_path)
+    index[url] = {"sha256": actual, "etag": meta["etag"], "last_modified": meta["last_modified"]}
+    with open(index_path + ".tmp", "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.rename(index_path + ".tmp", index_path)
+    return cache_path
+
+class ConfDiff(object):
+    """agentd 配置相对于 agent2 配置的差异。
+
+    Attributes:
+        update_items: agent2 中已存在但值不同的项，[(<key>, <value>), ...]。
+        add_items: agent2 中不存在的项，多值参数按缺少的值逐个列出。
+        unsupported_items: agentd 中存在而 agent2 不支持的项。
+        ordered_items: 与 agent2 不一致时 agentd 中 CONF_ORDERED_ITEMS 的全部项（按 agentd 的顺序），
+            整体替换 agent2 中的这些项，一致时为空。
     """
-    res = []
-    for i in items:
-        if i[0] == k:
+    def __init__(self):
+        self.update_items = []
+        self.add_items = []
+        self.unsupported_items = []
+        self.ordered_items = []
+
+    def __nonzero__(self):
+        return bool(self.update_items or self.add_items or self.ordered_items)
+
+    def merge(self, agent2_conf, items):
+        """并入额外生成的单值项，按 agent2 中是否已存在归入 update_items 或 add_items。
+
+        Args:
+            agent2_conf: agent2 配置的 ZbxConf。
+            items: [(<key>, <value>), ...]
+        """
+        for k, v in items:
+            if k not in agent2_conf.index:
+                self.add_items.append((k, v))
+            elif agent2_conf.get(k) != v:
+                self.update_items.append((k, v))
+
+    def to_dict(self):
+        return {
+            "update_items": self.update_items,
+            "add_items": self.add_items,
+            "unsupported_items": self.unsupported_items,
+            "ordered_items": self.ordered_items,
+        }
+
+def diff_zbx_conf(agentd_conf, agent2_conf, ignore_not_support_params=False):
+    """以 key 索引对比 agentd 和 agent2 的配置，只遍历一次 agentd 的配置。
+
+    CONF_ORDERED_ITEMS 中的项作为一个有序的整体比较，顺序不同也视为差异。
+
+    Args:
+        agentd_conf: agentd 配置的 ZbxConf。
+        agent2_conf: agent2 配置的 ZbxConf。
+        ignore_not_support_params: 是否将 agent2 不支持的项排除在 update/add 之外。
+    Returns:
+        <ConfDiff>: 配置差异。
+    """
+    diff = ConfDiff()
+    not_support = set(CONF_AGENT2_NOTSUPPORT_PARAMS)
+    multi_value = set(CONF_MULTI_VALUE_ITEMS)
+    ordered = set(CONF_ORDERED_ITEMS)
+    for k, values in agentd_conf.index.items():
+        if k in not_support:
+            diff.unsupported_items.extend((k, v) for v in values)
+            if ignore_not_support_params:
+                continue
+        if k in ordered:
             continue
-        res.append(i)
+        if k in multi_value:
+            exists = set(agent2_conf.get_all(k))
+            for v in values:
+                if v not in exists:
+                    exists.add(v)
+                    diff.add_items.append((k, v))
+        elif k not in agent2_conf.index:
+            diff.add_items.append((k, values[-1]))
+        elif agent2_conf.get(k) != values[-1]:
+            diff.update_items.append((k, values[-1]))
+    if agentd_conf.ordered_items and agentd_conf.ordered_items != agent2_conf.ordered_items:
+        diff.ordered_items = list(agentd_conf.ordered_items)
+    return diff
+
+_AGENT2_PLUGIN_INDEX = dict((k, p) for p, keys in CONF_AGENT2_PLUGINS.items() for k in keys)
+
+def agent2_plugin_of(key):
+    """返回提供该 key 的 agent2 插件名，不在 CONF_AGENT2_PLUGINS 中的返回 None。
+    """
+    key = key.split("[", 1)[0].strip()
+    if key in _AGENT2_PLUGIN_INDEX:
+        return _AGENT2_PLUGIN_INDEX[key]
+    parts = key.split(".")
+    for i in range(len(parts) - 1, 0, -1):
+        prefix = ".".join(parts[:i]) + "."
+        if prefix in _AGENT2_PLUGIN_INDEX:
+            return _AGENT2_PLUGIN_INDEX[prefix]
+    return None
+
+def get_cpu_count(root=""):
+    """返回主机的 CPU 数。
+
+    Args:
+        root: 可选，主机配置快照的根目录，从快照中的 /proc/cpuinfo 读取。
+    Returns:
+        <int>: CPU 数，快照中没有 /proc/cpuinfo 时为 None。
+    """
+    if not root:
+        return multiprocessing.cpu_count()
+    path = os.path.join(root, "proc/cpuinfo")
+    if not os.path.isfile(path):
+        return None
+    with open(path, "r") as f:
+        count = sum(1 for line in f if re.match(r"processor\s*:", line))
+    return count or None
+
+def used_agent2_plugins(agentd_conf, conflict_dict, up_count):
+    """统计主机实际使用的 agent2 插件及其服务的 key 数量。
+
+    UserParameter 插件取生效的 UserParameter 数量；允许远程命令时计入 SystemRun；
+    内置插件取配置中出现的内置 key：与内置 key 冲突的 UserParameter（由内置插件接管）和 Alias 指向的 key。
+
+    Args:
+        agentd_conf: agentd 配置的 ZbxConf。
+        conflict_dict: check_conflict_up 返回的冲突报告。
+        up_count: agent2 中生效的 UserParameter 数量。
+    Returns:
+        <dict>: {<plugin>: <key 数量>}
+    """
+    keys = [k for v in conflict_dict.values() for k in v]
+    for i in agentd_conf.get_all("Alias"):
+        if ":" in i:
+            keys.append(i.split(":", 1)[1])
+    if str(agentd_conf.get("EnableRemoteCommands")).strip() == "1" or \
+            any(i.strip().startswith("system.run") for i in agentd_conf.get_all("AllowKey")):
+        keys.append("system.run")
+    res = {}
+    for key in keys:
+        plugin = agent2_plugin_of(key)
+        if plugin:
+            res[plugin] = res.get(plugin, 0) + 1
+    if up_count:
+        res["UserParameter"] = up_count
     return res
 
+def plugin_capacity_items(agentd_conf, used, mode=PLUGIN_CAPACITY_MODE, cpu_count=None):
+    """将 agentd 的 StartAgents 转换为 agent2 中主机所使用插件的 Plugins.<name>.Capacity。
+
+    agentd 的被动检查由 StartAgents 个进程共同处理，agent2 则按插件分别限制并发。
+    startagents 方式下每个插件都保留 StartAgents 的并发；auto 方式下总并发取 StartAgents
+    与 CPU 数 * PLUGIN_CAPACITY_PER_CPU 的较大者，每个插件先分得 1，其余按各插件服务的 key 数量分配，
+    各插件之和不超过总并发（插件数多于总并发时除外）。无法得到 CPU 数时 auto 退化为 startagents。
+
+    Args:
+        agentd_conf: agentd 配置的 ZbxConf。
+        used: used_agent2_plugins 返回的 {<plugin>: <key 数量>}。
+        mode: PLUGIN_CAPACITY_MODE 中的一种。
+        cpu_count: CPU 数。
+    Returns:
+        <list>: [(<key>, <value>), ...]
+    """
+    if mode == "none":
+        return []
+    if mode not in ("startagents", "auto"):
+        raise Exception("unknown plugin capacity mode: {!s}".format(mode))
+    start_agents = agentd_conf.get("StartAgents")
+    if start_agents is not None:
+        start_agents = int(start_agents)
+        if start_agents == 0:
+            logging.warning("StartAgents=0 disables passive checks, which is not supported by agent2, skip the plugin capacity")
+            return []
+    if mode == "auto" and not cpu_count:
+        logging.warning("cannot get the cpu count, size the plugin capacity by StartAgents")
+        mode = "startagents"
+    if mode == "startagents" and start_agents is None:
+        return []
+    if not used:
+        return []
+
+    plugins = sorted(used)
+    if mode == "auto":
+        budget = max(start_agents or 0, cpu_count * PLUGIN_CAPACITY_PER_CPU, len(plugins))
+        total = sum(used.values())
+        rest = budget - len(plugins)
+        shares = dict((p, float(rest) * used[p] / total) for p in plugins)
+        capacity = dict((p, 1 + int(shares[p])) for p in plugins)
+        # 按最大余数分配取整后剩余的并发
+        left = budget - sum(capacity.values())
+        for p in sorted(plugins, key=lambda p: shares[p] - int(shares[p]), reverse=True)[:left]:
+            capacity[p] += 1
+    else:
+        capacity = dict((p, start_agents) for p in plugins)
+
+    res = []
+    for plugin in plugins:
+        value = min(max(capacity[plugin], PLUGIN_CAPACITY_MIN), PLUGIN_CAPACITY_MAX)
+        logging.info("plugin {!s} serves {!s} keys, capacity: {!s}".format(plugin, used[plugin], value))
+        res.append(("Plugins.{!s}.Capacity".format(plugin), str(value)))
+    return res
+
+def merge_plugin_capacity(diff, agentd_conf_path, agent2_conf, mode=PLUGIN_CAPACITY_MODE, root=""):
+    """将 StartAgents 转换得到的插件 Capacity 并入配置差异。
+
+    Args:
+        diff: diff_zbx_conf 得到的 ConfDiff。
+        agentd_conf_path: agentd 的配置文件路径。
+        agent2_conf: agent2 配置的 ZbxConf。
+        mode: PLUGIN_CAPACITY_MODE 中的一种。
+        root: 可选，主机配置快照的根目录。
+    """
+    if mode == "none":
+        return
+    conflict_dict, up_dict = check_conflict_up(agentd_conf_path, root)
+    # 冲突的 UserParameter 在 agent2 中会被注释掉
+    up_count = sum(len(v) for v in up_dict.values()) - sum(len(v) for v in conflict_dict.values())
+    agentd_conf = load_zbx_conf(agentd_conf_path)
+    diff.merge(agent2_conf, plugin_capacity_items(
+        agentd_conf,
+        used_agent2_plugins(agentd_conf, conflict_dict, up_count),
+        mode,
+        get_cpu_count(root),
+    ))
+
+def undo_file_lines(path, changes):
+    """恢复 file_lines 记录中被改写的行，行号变化时按内容查找。
+    """
+    if not os.path.isfile(path):
+        logging.error("cannot found {!s}, skip rollback of its lines".format(path))
+        return
+    with open(path, "r") as f:
+        line_list = f.readlines()
+    for c in reversed(changes):
+        idx = c["line"] - 1
+        if idx >= len(line_list) or line_list[idx] != c["new"]:
+            idx = line_list.index(c["new"]) if c["new"] in line_list else -1
+        if idx < 0:
+            logging.error("cannot found the changed line on {!s}: {!s}".format(path, c["new"].strip()))
+            continue
+        line_list[idx] = c["old"]
+        logging.info("rollback line on {!s}:{!s}: {!s}".format(path, idx + 1, c["old"].strip()))
+    atomic_write(path, "".join(line_list))
+    invalidate_zbx_conf(path)
+
+def rollback_journal(path=JOURNAL_PATH, backup_dir=JOURNAL_BACKUP_DIR):
+    """逆序重放改动日志，耗时只与改动的数量有关。
+
+    服务的停止和禁用按逆序立即执行，启动和启用推迟到所有文件和 rpm 恢复之后，
+    避免服务在配置恢复前被拉起。
+
+    Returns:
+        <int>: 回滚的记录数。
+    """
+    journal = Journal(path, backup_dir)
+    entries = journal.entries()
+    rpm_done = set(e["intent"] for e in entries if e["op"] == "rpm_done" and e["ok"])
+    deferred = []
+    for e in reversed(entries):
+        op = e["op"]
+        if op == "rpm_done":
+            continue
+        if op == "rpm" and e["seq"] not in rpm_done and query_rpm(e["package"]) == e["previous"]:
+            logging.info("rpm transaction of {!s} was not applied, skip it".format(e["installed"]))
+            continue
+        if op == "service":
+            if not e["active"]:
+                systemctl_action("stop", e["service"])
+            if not e["enabled"]:
+                systemctl_action("disable", e["service"])
+            deferred.append(e)
+        elif op == "file_lines":
+            undo_file_lines(e["path"], e["changes"])
+        elif op == "file_write":
+            if e["backup"]:
+                with open(e["backup"], "r") as f:
+                    atomic_write(e["path"], f.read())
+                logging.info("rollback {!s} from {!s}".format(e["path"], e["backup"]))
+            elif os.path.isfile(e["path"]):
+                os.remove(e["path"])
+                logging.info("rollback {!s} by removing it".format(e["path"]))
+            invalidate_zbx_conf(e["path"])
+        elif op == "rpm":
+            if e["previous"] is None:
+                if not lnx_command_execute(["rpm", "-evh", e["package"]]):
+                    raise Exception("cannot remove the rpm {!s}".format(e["package"]))
+            else:
+                logging.warning("{!s} was replaced by {!s}, please reinstall {!s} manually if needed".format(
+                    e["previous"], e["installed"], e["previous"]))
+        else:
+            logging.warning("unknown journal op {!s}, skip it".format(op))
+    for e in reversed(deferred):
+        if e["active"]:
+            systemctl_action("start", e["service"])
+        if e["enabled"]:
+            systemctl_action("enable", e["service"])
+    journal.archive()
+    emit_event("rollback", entries=len(entries), ok=True)
+    return len(entries)
+
+def rollback_conflict_up(conf_path):
+    """恢复早期版本加上 ".agent2upgrade.disable" 后缀移走的 Include 文件，只用于没有改动日志的安装。
+
+    Args:
+        conf_path: agentd 的配置文件路径。
+    Returns:
+        <int>: 恢复的文件数。
+    """
+    if not os.path.isfile(conf_path):
+        return 0
+    suffix = ".agent2upgrade.disable"
+    count = 0
+    for pattern in load_zbx_conf(conf_path).get_all("Include"):
+        if os.path.isdir(pattern):
+            pattern = os.path.join(pattern, "*")
+        for f in sorted(glob.glob(pattern + suffix)):
+            enable_path = f[:-len(suffix)]
+            if not os.path.isfile(f):
+                continue
+            if os.path.exists(enable_path):
+                logging.warning("{!s} exists, skip restoring it from {!s}".format(enable_path, f))
+                continue
+            shutil.move(f, enable_path)
+            invalidate_zbx_conf(enable_path)
+            logging.info("rollback conflict UserParameter on outer config: {!s} -> {!s}".format(f, enable_path))
+            count += 1
+    return count
+
 def rollback_agentd():
     """回滚 Zabbix-Agent2 安装，如果存在 Zabbix-Agent 则将其拉起。
+
+    存在改动日志时只逆序重放改动日志，耗时与 Include 的数量无关；否则恢复早期版本移走的 Include 文件，
+    再切换服务。
     """
     if not os.path.isfile(AGENTD_CONF) and not os.path.isfile(AGENTD_PATH):
         raise Exception("not found agentd files")
-    if os.path.isfile(AGENT2_PATH):
-        if not systemctl_action("stop", "zabbix-agent2"):
-            raise Exception("cannot systemctl stop zabbix-agent2")
-        if not systemctl_action("disable", "zabbix-agent2"):
-            logging.error("cannot systemctl disable zabbix-agent2")
-
-    rollback_conflict_up(AGENTD_CONF)
-
-    if not systemctl_action("start", "zabbix-agent"):
-        raise Exception("cannot systemctl start zabbix-agent")
-    if not systemctl_action("enable", "zabbix-agent"):
-        logging.error("cannot systemctl enable zabbix-agent")
-    time.sleep(1)
-    if not systemctl_action("status", "zabbix-agent"):
-        raise Exception("zabbix-agent status is not good, please check")
+    if os.path.isfile(JOURNAL_PATH):
+        logging.info("rollback {!s} entries from the journal".format(rollback_journal()))
+    else:
+        rollback_conflict_up(AGENTD_CONF)
+        if os.path.isfile(AGENT2_PATH):
+            if not systemctl_action("stop", "zabbix-agent2"):
+                raise Exception("cannot systemctl stop zabbix-agent2")
+            if not systemctl_action("disable", "zabbix-agent2"):
+                logging.error("cannot systemctl disable zabbix-agent2")
+        if not systemctl_action("start", "zabbix-agent"):
+            raise Exception("cannot systemctl start zabbix-agent")
+        if not systemctl_action("enable", "zabbix-agent"):
+            logging.error("cannot systemctl enable zabbix-agent")
+    if wait_agent_ready(*get_agent_listen(AGENTD_CONF)) is None:
+        raise Exception("zabbix-agent is not ready, please check")
 
 def upgrade_pre(is_force=False):
     """升级前的检查和信息反馈。
@@ -406,75 +2042,95 @@ def upgrade_pre(is_force=False):
     # echo current agentd version
     if os.path.isfile(AGENTD_PATH):
         command_lst = [AGENTD_PATH, "--version"]
-        pipe = subprocess.Popen(command_lst, stdout=subprocess.PIPE)
-        info_echo("version", pipe.stdout.read().decode("utf-8").strip())
+        res = run_command(command_lst, timeout=10, log_level=None)
+        info_echo("version", "\n".join(res.output).strip())
 
 def has_not_support_params(agentd_conf_path):
     """
     """
     has_not_support = False
-    for i in parse_zbx_conf(agentd_conf_path):
+    for i in load_zbx_conf(agentd_conf_path).items():
         if i[0].strip() in CONF_AGENT2_NOTSUPPORT_PARAMS:
             logging.warning("the agent2 not suport the param: {!s}".format(i[0].strip()))
             has_not_support = True
     return has_not_support
 
-def install_agent2_rpm(url, is_force=False):
-    """安装 agnet2 的 rpm 包。
+def query_rpm(package):
+    """返回已安装的包的 NEVRA，未安装返回 None。
     """
+    res = run_command(["rpm", "-q", package], timeout=60, log_level=None)
+    return res.output[0].strip() if res.returncode == 0 and res.output else None
+
+def install_agent2_rpm(url, is_force=False, sha256=None):
+    """安装 agnet2 的 rpm 包，安装包通过 fetch_rpm 下载到本地缓存后再交给 rpm。
+
+    先以 rpm --test 检查依赖，检查通过后再以一个事务完成安装；已安装且允许强制时，
+    使用升级/替换的事务代替先卸载再安装，事务失败时原有的 agent2 依然保留。
+
+    Returns:
+        <OrderedDict>: 各阶段的耗时秒数。
+    """
+    timings = OrderedDict()
+    start = time.time()
+    rpm_path = fetch_rpm(url, sha256)
+    timings["fetch"] = time.time() - start
+
     if is_force and os.path.isfile(AGENT2_PATH):
-        command_lst = ["rpm", "-evh", "zabbix-agent2"]
-        if lnx_command_execute(command_lst):
-            logging.info("zabbix-agent2 is removed successfully")
-        else:
-            logging.error("zabbix-agent2 removing is failed")
-            raise Exception()
+        command_lst = ["rpm", "-Uvh", "--replacepkgs", "--oldpackage", rpm_path]
+    else:
+        command_lst = ["rpm", "-ivh", rpm_path]
+
+    start = time.time()
+    if not lnx_command_execute(command_lst[:2] + ["--test"] + command_lst[2:]):
+        logging.error("zabbix-agent2 rpm testing is failed, nothing is changed")
+        raise Exception("zabbix-agent2 rpm testing is failed")
+    timings["test"] = time.time() - start
+
+    previous = query_rpm("zabbix-agent2")
 
-    if not url_test(url):
-        raise Exception("cannot access the rpm url: {!s}".format(url))
-    command_lst = ["rpm", "-ivh", url]
-    if lnx_command_execute(command_lst):
+    # 事务中断（如被 kill 或断电）时，回滚依据该记录和 rpm 的实际状态判断是否需要恢复
+    intent = journal_record("rpm", package="zabbix-agent2", previous=previous, installed=rpm_path)
+    start = time.time()
+    ok = lnx_command_execute(command_lst)
+    if intent is not None:
+        journal_record("rpm_done", intent=intent["seq"], ok=ok)
+    if ok:
         logging.info("zabbix-agent2 rpm is installed successfully")
     else:
         logging.error("zabbix-agent2 rpm installing is failed")
-        raise Exception()
+        raise Exception("zabbix-agent2 rpm installing is failed")
+    timings["transaction"] = time.time() - start
 
-def conv_agent2_conf(agentd_conf_path, agent2_conf_path, is_force, ignore_not_support_params):
+    for k, v in timings.items():
+        logging.info("rpm phase {!s} cost {:.3f}s".format(k, v))
+        emit_event("phase", name="install." + k, duration=round(v, 6), ok=True)
+    return timings
+
+def conv_agent2_conf(agentd_conf_path, agent2_conf_path, is_force, ignore_not_support_params, capacity_mode=PLUGIN_CAPACITY_MODE):
     """对齐存在的 agentd 的配置。
     """
-    agentd_items = parse_zbx_conf(agentd_conf_path)
-    agent2_items = parse_zbx_conf(agent2_conf_path)
-    diff_set = set()
-    add_set = set()
-    for i in agentd_items:
-        has_found = False
-        is_diff = False
-        for j in agent2_items:
-            if i[0] == j[0]:
-                has_found = True
-                if i[1] != j[1]:
-                    is_diff = True
-        if not has_found:
-            add_set.add(i[0])
-        else:
-            if is_diff:
-                diff_set.add(i[0])
-
-    if len(diff_set) == 0 and len(add_set) == 0:
-        return 
-
-    update_items = [(i[0], i[1]) for i in agentd_items if i[0] in diff_set]
-    add_items = [(i[0], i[1]) for i in agentd_items if i[0] in add_set]
     if ignore_not_support_params:
         logging.info("excluding not support params ......")
-        for i in CONF_AGENT2_NOTSUPPORT_PARAMS:
-            update_items = remove_item_pair_value(update_items, i)
-            add_items = remove_item_pair_value(add_items, i)
+    with phase_timer("conv.diff"):
+        agent2_conf = load_zbx_conf(agent2_conf_path)
+        diff = diff_zbx_conf(
+            load_zbx_conf(agentd_conf_path),
+            agent2_conf,
+            ignore_not_support_params,
+        )
+    with phase_timer("conv.capacity"):
+        merge_plugin_capacity(diff, agentd_conf_path, agent2_conf, capacity_mode)
+    if not diff:
+        return
+
+    update_items, add_items = diff.update_items, diff.add_items
     logging.debug("in conv_agent2_conf, update_items: {!s}".format(str(update_items)))
     logging.debug("in conv_agent2_conf, add_items: {!s}".format(str(add_items)))
-    update_diff_conf(AGENT2_CONF, update_items, add_items, CONF_IGNORE_ITEM)
+    with phase_timer("conv.rewrite"):
+        update_diff_conf(agent2_conf_path, update_items, add_items, CONF_IGNORE_ITEM, diff.ordered_items)
 
-    has_conflict, up_dict = check_conflict_up(AGENT2_CONF)
+    with phase_timer("conv.conflict_scan"):
+        conflict_dict, up_dict = check_conflict_up(agent2_conf_path)
 
     logging.debug("="*10 + " all UserParameter:")
     for i in up_dict:
@@ -483,11 +2139,15 @@ def conv_agent2_conf(agentd_conf_path, agent2_conf_path, is_force, ignore_not_su
             logging.debug("\t{!s}".format(j))
     logging.debug("="*10 + " EOF all UserParameter")
 
-    if has_conflict:
+    if conflict_dict:
         logging.warning("found conflict UserParameter in the config")
+        for i in sorted(conflict_dict):
+            for j in conflict_dict[i]:
+                logging.warning("conflict UserParameter on {!s}: {!s}".format(i, j))
         if not is_force:
             raise Exception("not force, exit the progress")
-        deal_conflict_up(up_dict)
+        with phase_timer("conv.conflict_deal"):
+            deal_conflict_up(conflict_dict)
 
 def conv_agent2_enable():
     """
@@ -499,57 +2159,956 @@ def conv_agent2_enable():
         if not systemctl_action("disable", "zabbix-agent"):
             logging.error("systemctl disable zabbix-agent is failed, please check")
             return False
-        time.sleep(1)
     if not systemctl_action("start", "zabbix-agent2"):
         logging.error("systemctl start zabbix-agent2 is failed, please check")
         return False
     if not systemctl_action("enable", "zabbix-agent2"):
         logging.error("systemctl enable zabbix-agent2 is failed, please check")
         return False
-    time.sleep(1)
-    if not systemctl_action("status", "zabbix-agent2"):
-        logging.error("systemctl status zabbix-agent2 is failed, please check")
+    if wait_agent_ready(*get_agent_listen(AGENT2_CONF)) is None:
+        logging.error("zabbix-agent2 is not ready, please check")
         return False
 
     return True
 
-def execute(url, can_remove, ignore_not_support_params, deal_with_up, exec_rollback):
+def validate_agent2_conf(agent2_conf_path):
+    """使用 agent2 加载配置并测试 agent.ping，校验配置是否可用，不影响运行中的服务。
+    """
+    command_lst = [AGENT2_PATH, "-c", agent2_conf_path, "-t", "agent.ping"]
+    return lnx_command_execute(command_lst)
+
+def extract_rpm_file(rpm_path, member):
+    """从 rpm 包中读取一个文件的内容，不安装 rpm 包。
+
+    Args:
+        rpm_path: rpm 包的本地路径。
+        member: 文件在包中的绝对路径，如 /etc/zabbix/zabbix_agent2.conf。
+    Returns:
+        <str>: 文件内容。
+    """
+    rpm2cpio = subprocess.Popen(["rpm2cpio", rpm_path], stdout=subprocess.PIPE)
+    cpio = subprocess.Popen(
+        ["cpio", "-i", "--quiet", "--to-stdout", "." + member],
+        stdin=rpm2cpio.stdout,
+        stdout=subprocess.PIPE,
+    )
+    rpm2cpio.stdout.close()
+    content, _ = cpio.communicate()
+    rpm2cpio.wait()
+    if rpm2cpio.returncode != 0 or cpio.returncode != 0 or not content:
+        raise Exception("cannot extract {!s} from {!s}".format(member, rpm_path))
+    return content
+
+def plan_upgrade(agentd_conf_path, agent2_template, ignore_not_support_params=False, rpm_sha256=None,
+        capacity_mode=PLUGIN_CAPACITY_MODE):
+    """只读地计算升级时 conv_agent2_conf 和 deal_conflict_up 会做的改动，不触碰服务、rpm 包和配置文件。
+
+    Args:
+        agentd_conf_path: agentd 的配置文件路径。
+        agent2_template: agent2 配置模板的来源，rpm 包的 URL/路径或 zabbix_agent2.conf 的路径。
+        ignore_not_support_params: 是否将 agent2 不支持的项排除在 update/add 之外。
+        rpm_sha256: 可选，rpm 包的 sha256。
+        capacity_mode: StartAgents 转换为插件 Capacity 的方式。
+    Returns:
+        <OrderedDict>: 可序列化为 JSON 的升级计划。
+    """
+    start = time.time()
+    tmp_dir = tempfile.mkdtemp(prefix="zbx_agent2upgrade.plan.")
+    try:
+        if agent2_template.endswith(".rpm") or "://" in agent2_template:
+            with open(os.path.join(tmp_dir, "template.conf"), "w") as f:
+                f.write(extract_rpm_file(fetch_rpm(agent2_template, rpm_sha256), AGENT2_CONF))
+            template_path = f.name
+        else:
+            template_path = agent2_template
+        with open(template_path, "r") as f:
+            template_lines = f.readlines()
+
+        template_conf = load_zbx_conf(template_path)
+        diff = diff_zbx_conf(load_zbx_conf(agentd_conf_path), template_conf, ignore_not_support_params)
+        merge_plugin_capacity(diff, agentd_conf_path, template_conf, capacity_mode)
+        plan_path = os.path.join(tmp_dir, os.path.basename(AGENT2_CONF))
+        with open(plan_path, "w") as f:
+            f.write("".join(rewrite_conf_lines(template_lines, diff.update_items, diff.add_items, CONF_IGNORE_ITEM,
+                ordered_items=diff.ordered_items)))
+        conflict_dict, up_dict = check_conflict_up(plan_path)
+        invalidate_zbx_conf(plan_path)
+        invalidate_zbx_conf(template_path)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    # 临时文件的路径换回升级后 agent2 配置的实际路径
+    self_key = "@{!s}".format(plan_path)
+    conflicts = OrderedDict()
+    for k in sorted(conflict_dict):
+        conflicts["@" + AGENT2_CONF if k == self_key else k] = conflict_dict[k]
+    res = OrderedDict()
+    res["host"] = platform.node()
+    res["agentd_conf"] = agentd_conf_path
+    res["agent2_template"] = agent2_template
+    res["update_items"] = [i for i in diff.update_items if i[0] not in CONF_IGNORE_ITEM]
+    res["add_items"] = [i for i in diff.add_items if i[0] not in CONF_IGNORE_ITEM]
+    res["ordered_items"] = diff.ordered_items
+    res["unsupported_items"] = diff.unsupported_items
+    res["conflicts"] = conflicts
+    res["userparameter_count"] = sum(len(v) for v in up_dict.values())
+    res["duration"] = round(time.time() - start, 6)
+    return res
+
+def snapshot_fingerprint(root, agent2_template_path, ignore_not_support_params, capacity_mode=PLUGIN_CAPACITY_MODE):
+    """计算主机配置快照的内容哈希，包括 agentd 配置、所有 Include 文件（含嵌套）和 agent2 模板。
+
+    Args:
+        root: 主机配置快照的根目录，为空表示本机。
+        agent2_template_path: agent2 配置模板的路径。
+        ignore_not_support_params: 是否排除 agent2 不支持的项。
+        capacity_mode: StartAgents 转换为插件 Capacity 的方式，auto 时包括 CPU 数。
+    Returns:
+        <str>: sha256。
+    """
+    h = hashlib.sha256()
+    h.update(str(bool(ignore_not_support_params)))
+    h.update("|{!s}|{!s}|".format(capacity_mode, get_cpu_count(root) if capacity_mode == "auto" else ""))
+    with open(agent2_template_path, "rb") as f:
+        h.update(f.read())
+    seen = set()
+    pending = [AGENTD_CONF]
+    while pending:
+        path = pending.pop(0)
+        real_path = os.path.join(root, path.lstrip("/")) if root else path
+        if path in seen or not os.path.isfile(real_path):
+            continue
+        seen.add(path)
+        with open(real_path, "rb") as f:
+            content = f.read()
+        h.update(path + "\0" + content + "\0")
+        for line in content.splitlines():
+            item = tokenize_zbx_line(line)
+            if item and item[0] == "Include":
+                for i in expand_include(item[1], root):
+                    pending.append("/" + os.path.relpath(i, root) if root else i)
+    return h.hexdigest()
+
+def convert_snapshot(root, agent2_template_path, output_dir, ignore_not_support_params=False,
+        capacity_mode=PLUGIN_CAPACITY_MODE):
+    """离线转换一台主机的配置快照，生成可直接部署的 agent2 配置。
+
+    与升级时一致：以 diff_zbx_conf 和 rewrite_conf_lines 生成配置，再以 check_conflict_up 检查冲突，
+    生成的配置中冲突的 UserParameter 行通过 deal_conflict_up 注释掉，Include 文件中的冲突只报告。
+
+    Args:
+        root: 主机配置快照的根目录。
+        agent2_template_path: agent2 配置模板的路径。
+        output_dir: 输出目录，生成 zabbix_agent2.conf 和 result.json。
+        ignore_not_support_params: 是否排除 agent2 不支持的项。
+        capacity_mode: StartAgents 转换为插件 Capacity 的方式，auto 时使用快照中 /proc/cpuinfo 的 CPU 数。
+    Returns:
+        <OrderedDict>: 转换结果，路径均为主机上的路径。
+    """
+    agentd_conf_path = os.path.join(root, AGENTD_CONF.lstrip("/"))
+    out_path = os.path.join(output_dir, os.path.basename(AGENT2_CONF))
+    with open(agent2_template_path, "r") as f:
+        template_lines = f.readlines()
+    template_conf = load_zbx_conf(agent2_template_path)
+    diff = diff_zbx_conf(load_zbx_conf(agentd_conf_path), template_conf, ignore_not_support_params)
+    merge_plugin_capacity(diff, agentd_conf_path, template_conf, capacity_mode, root)
+    with open(out_path, "w") as f:
+        f.write("".join(rewrite_conf_lines(template_lines, diff.update_items, diff.add_items, CONF_IGNORE_ITEM,
+            ordered_items=diff.ordered_items)))
+
+    self_key = "@{!s}".format(out_path)
+    conflict_dict, up_dict = check_conflict_up(out_path, root)
+    if self_key in conflict_dict:
+        deal_conflict_up({self_key: conflict_dict[self_key]})
+    invalidate_zbx_conf(agentd_conf_path)
+    invalidate_zbx_conf(out_path)
+
+    conflicts = OrderedDict()
+    for k in sorted(conflict_dict):
+        conflicts["@" + AGENT2_CONF if k == self_key else "/" + os.path.relpath(k, root)] = conflict_dict[k]
+    res = OrderedDict()
+    res["update_items"] = [i for i in diff.update_items if i[0] not in CONF_IGNORE_ITEM]
+    res["add_items"] = [i for i in diff.add_items if i[0] not in CONF_IGNORE_ITEM]
+    res["ordered_items"] = diff.ordered_items
+    res["unsupported_items"] = diff.unsupported_items
+    res["conflicts"] = conflicts
+    res["userparameter_count"] = sum(len(v) for v in up_dict.values())
+    with open(os.path.join(output_dir, "result.json"), "w") as f:
+        json.dump(res, f, indent=2)
+    return res
+
+def _bulk_convert_worker(args):
+    fingerprint, root, agent2_template_path, output_dir, ignore_not_support_params, capacity_mode = args
+    try:
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        convert_snapshot(root, agent2_template_path, output_dir, ignore_not_support_params, capacity_mode)
+        return fingerprint, None
+    except Exception as e:
+        logging.exception(e)
+        return fingerprint, str(e)
+
+def bulk_convert(store_dir, agent2_template_path, output_dir, ignore_not_support_params=False, workers=None,
+        capacity_mode=PLUGIN_CAPACITY_MODE):
+    """使用进程池离线转换 store_dir 下所有主机的配置快照，内容相同的快照只转换一次。
+
+    转换结果按内容哈希缓存于 <output_dir>/.by-hash/<sha256>，再次执行时已有的结果直接复用。
+
+    Args:
+        store_dir: 快照目录，每个子目录为一台主机的根目录。
+        agent2_template_path: agent2 配置模板的路径。
+        output_dir: 输出目录。
+        ignore_not_support_params: 是否排除 agent2 不支持的项。
+        workers: 进程数，默认为 CPU 数。
+        capacity_mode: StartAgents 转换为插件 Capacity 的方式。
+    Returns:
+        <dict>: {<host>: <result>}
+    """
+    start = time.time()
+    hash_dir = os.path.join(output_dir, ".by-hash")
+    groups = OrderedDict()
+    for host in sorted(os.listdir(store_dir)):
+        root = os.path.join(store_dir, host)
+        if not os.path.isfile(os.path.join(root, AGENTD_CONF.lstrip("/"))):
+            logging.warning("not found agentd config in the snapshot of {!s}, skip it".format(host))
+            continue
+        fingerprint = snapshot_fingerprint(root, agent2_template_path, ignore_not_support_params, capacity_mode)
+        groups.setdefault(fingerprint, []).append(host)
+
+    tasks = []
+    for fingerprint, hosts in groups.items():
+        if os.path.isfile(os.path.join(hash_dir, fingerprint, "result.json")):
+            continue
+        tasks.append((
+            fingerprint,
+            os.path.join(store_dir, hosts[0]),
+            agent2_template_path,
+            os.path.join(hash_dir, fingerprint),
+            ignore_not_support_params,
+            capacity_mode,
+        ))
+    logging.info("bulk convert {!s} hosts, {!s} unique configs, {!s} to convert".format(
+        sum(len(v) for v in groups.values()), len(groups), len(tasks)))
+
+    errors = {}
+    if tasks:
+        pool = multiprocessing.Pool(workers or multiprocessing.cpu_count())
+        try:
+            for fingerprint, error in pool.imap_unordered(_bulk_convert_worker, tasks):
+                if error:
+                    errors[fingerprint] = error
+        finally:
+            pool.close()
+            pool.join()
+
+    summary = {}
+    for fingerprint, hosts in groups.items():
+        result = {"fingerprint": fingerprint}
+        if fingerprint in errors:
+            result["error"] = errors[fingerprint]
+        else:
+            src_dir = os.path.join(hash_dir, fingerprint)
+            with open(os.path.join(src_dir, "result.json"), "r") as f:
+                result.update(json.load(f))
+        for host in hosts:
+            summary[host] = result
+            if "error" in result:
+                continue
+            host_dir = os.path.join(output_dir, host)
+            if not os.path.isdir(host_dir):
+                os.makedirs(host_dir)
+            shutil.copyfile(
+                os.path.join(src_dir, os.path.basename(AGENT2_CONF)),
+                os.path.join(host_dir, os.path.basename(AGENT2_CONF)),
+            )
+    with open(os.path.join(output_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+    logging.info("bulk convert is finished, cost {:.3f}s, {!s} failed".format(
+        time.time() - start, sum(len(groups[i]) for i in errors)))
+    return summary
+
+def cutover_agent2(agent2_conf_path=AGENT2_CONF):
+    """最小中断地从 agentd 切换到 agent2，并测量监控中断的时长。
+
+    切换前先校验 agent2 的配置，校验失败则不触碰 agentd；切换时使用 disable --now 和 enable --now
+    各一次进程调用完成服务的交换，agent2 无法就绪时重新拉起 agentd。
+
+    Returns:
+        <float>: agentd 停止到 agent2 响应 agent.ping 的秒数，切换失败返回 None。
+    """
+    if not validate_agent2_conf(agent2_conf_path):
+        logging.error("the agent2 config {!s} is invalid, zabbix-agent is untouched".format(agent2_conf_path))
+        return None
+
+    stopped = time.time()
+    if os.path.isfile(AGENTD_PATH):
+        if not systemctl_action("disable", "zabbix-agent", now=True):
+            logging.error("systemctl disable --now zabbix-agent is failed, please check")
+            return None
+        stopped = time.time()
+    if systemctl_action("enable", "zabbix-agent2", now=True) and \
+            wait_agent_ready(*get_agent_listen(agent2_conf_path)) is not None:
+        gap = time.time() - stopped
+        info_echo("cutover", "monitoring gap: {:.3f}s".format(gap))
+        emit_event("cutover", duration=round(gap, 6), ok=True)
+        return gap
+
+    logging.error("zabbix-agent2 is not ready, bring zabbix-agent back")
+    if os.path.isfile(AGENTD_PATH):
+        systemctl_action("disable", "zabbix-agent2", now=True)
+        systemctl_action("enable", "zabbix-agent", now=True)
+    return None
+
+class Checkpoint(object):
+    """按阶段记录已完成的工作及其输入指纹，重复执行时跳过指纹相同且校验通过的阶段。
+
+    阶段按 CHECKPOINT_PHASES 的顺序，某个阶段重新完成时，其后的阶段记录失效。
+
+    Args:
+        path: 记录文件路径。
+    """
+    def __init__(self, path):
+        self.path = path
+        self.phases = {}
+        if os.path.isfile(path):
+            with open(path, "r") as f:
+                self.phases = json.load(f)
+
+    def get(self, phase, fingerprint=None):
+        rec = self.phases.get(phase)
+        if rec is None or (fingerprint is not None and rec["fingerprint"] != fingerprint):
+            return None
+        return rec
+
+    def done(self, phase, fingerprint, **fields):
+        for i in CHECKPOINT_PHASES[CHECKPOINT_PHASES.index(phase)+1:]:
+            self.phases.pop(i, None)
+        rec = {"fingerprint": fingerprint, "ts": round(time.time(), 6)}
+        rec.update(fields)
+        self.phases[phase] = rec
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        atomic_write(self.path, json.dumps(self.phases, indent=2, sort_keys=True))
+
+    def skip(self, phase, fingerprint, verify):
+        """判断阶段是否可以跳过。
+
+        Args:
+            phase: 阶段名。
+            fingerprint: 本次执行该阶段的输入指纹。
+            verify: 校验函数，参数为已完成的记录，返回该阶段的结果是否依然有效。
+        """
+        rec = self.get(phase, fingerprint)
+        if rec is None:
+            return False
+        try:
+            ok = verify(rec)
+        except Exception as e:
+            logging.warning("verify the checkpoint of {!s} is failed: {!s}".format(phase, e))
+            ok = False
+        if ok:
+            logging.info("phase {!s} has been done at {!s}, skip it".format(
+                phase, time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(rec["ts"]))))
+            emit_event("checkpoint", name=phase, skipped=True)
+        return ok
+
+def execute(url, can_remove, ignore_not_support_params, deal_with_up, exec_rollback, rpm_sha256=None, fast_cutover=False,
+        capacity_mode=PLUGIN_CAPACITY_MODE, up_rewrite=False, up_intervals=None, parity_check=False, parity_extra_keys=None):
     # Pre Checking
     if not exec_rollback and not url:
         raise Exception("please input the url param")
     # EOF Pre Checking
 
     if exec_rollback:
-        rollback_agentd()
+        with phase_timer("rollback"):
+            rollback_agentd()
+        if os.path.isfile(CHECKPOINT_PATH):
+            os.remove(CHECKPOINT_PATH)
         return
 
-    # 1. 抓取一次当前 agentd 的版本，备份 agentd 的文件。
-    upgrade_pre(can_remove)
-    # 2. 检查 Zabbix-Agent2 不支持的配置项
-    if not ignore_not_support_params and has_not_support_params(AGENTD_CONF):
-        raise Exception("found not support params, and choose not ignore them")
-    # 3. yum/rpm 安装对应的 agent2 rpm。
-    install_agent2_rpm(url, can_remove)
-    # 4. 根据现有的 agentd 的配置填充到 agent2 中。
-    if os.path.isfile(AGENTD_CONF):
-        conv_agent2_conf(AGENTD_CONF, AGENT2_CONF, deal_with_up, ignore_not_support_params)
-    # 5. systemctl stop zabbix-agent 或 service zabbix-agent stop。（这里最好 rhel7 的才升级）
-    # systemctl disable zabbix-agent
-    # systemctl start zabbix-agent2
-    # systemctl enable zabbix-agent2
-    # systemctl status zabbix-agent2
-    if not conv_agent2_enable():
-        raise Exception("conv agent2 systemd is failed")
-
-class MultiOrderedDict(OrderedDict):
-    """from https://stackoverflow.com/questions/15848674/how-to-configparse-a-file-keeping-multiple-values-for-identical-keys
-    """
-    def __setitem__(self, key, value):
-        if isinstance(value, list) and key in self:
-            self[key].extend(value)
-        else:
-            super(MultiOrderedDict, self).__setitem__(key, value)
-            # super().__setitem__(key, value) in Python 3
+    init_journal()
+    checkpoint = Checkpoint(CHECKPOINT_PATH)
+    # 上次中断时已由本脚本安装的 agent2 允许继续
+    installed_by_us = checkpoint.get("install") is not None and os.path.isfile(AGENT2_PATH)
+    with phase_timer("execute"):
+        # 1. 抓取一次当前 agentd 的版本，备份 agentd 的文件。
+        with phase_timer("pre"):
+            upgrade_pre(can_remove or installed_by_us)
+        # 2. 检查 Zabbix-Agent2 不支持的配置项
+        with phase_timer("not_support_check"):
+            if not ignore_not_support_params and has_not_support_params(AGENTD_CONF):
+                raise Exception("found not support params, and choose not ignore them")
+        # 3. yum/rpm 安装对应的 agent2 rpm。
+        with phase_timer("install"):
+            rpm_path = fetch_rpm(url, rpm_sha256)
+            fingerprint = rpm_sha256.lower() if rpm_sha256 else file_sha256(rpm_path)
+            if not checkpoint.skip("install", fingerprint,
+                    lambda rec: os.path.isfile(AGENT2_PATH) and query_rpm("zabbix-agent2") == rec["package"]):
+                # 以安装包中的配置作为转换的起点：强制重装同版本时不会生成 .rpmnew，
+                # 已安装的配置可能是上次转换的结果
+                pristine = extract_rpm_file(rpm_path, AGENT2_CONF)
+                install_agent2_rpm(rpm_path, can_remove or installed_by_us)
+                if not os.path.isdir(os.path.dirname(CHECKPOINT_AGENT2_CONF)):
+                    os.makedirs(os.path.dirname(CHECKPOINT_AGENT2_CONF))
+                atomic_write(CHECKPOINT_AGENT2_CONF, pristine)
+                checkpoint.done("install", fingerprint, package=query_rpm("zabbix-agent2"))
+        # 4. 根据现有的 agentd 的配置填充到 agent2 中。
+        with phase_timer("conv"):
+            # conv 会注释或改写 Include 文件中的 UserParameter，配置未再变化时以记录的 conv 前的快照计算指纹
+            snapshot = snapshot_fingerprint("", CHECKPOINT_AGENT2_CONF, ignore_not_support_params, capacity_mode)
+            rec = checkpoint.get("conv")
+            if rec is not None and rec.get("snapshot_after") == snapshot:
+                snapshot = rec["snapshot"]
+            fingerprint = hashlib.sha256("{!s}|{!s}|{!s}|{!s}".format(
+                checkpoint.get("install")["fingerprint"],
+                snapshot,
+                deal_with_up,
+                up_rewrite,
+            )).hexdigest()
+            if not checkpoint.skip("conv", fingerprint,
+                    lambda rec: file_sha256(AGENT2_CONF) == rec["agent2_conf_sha256"]):
+                # 从 rpm 的原始配置开始转换，重复执行时结果一致
+                with open(CHECKPOINT_AGENT2_CONF, "r") as f:
+                    pristine = f.read()
+                with open(AGENT2_CONF, "r") as f:
+                    if f.read() != pristine:
+                        journal_write_file(AGENT2_CONF, pristine)
+                if os.path.isfile(AGENTD_CONF):
+                    conv_agent2_conf(AGENTD_CONF, AGENT2_CONF, deal_with_up, ignore_not_support_params, capacity_mode)
+                if up_rewrite:
+                    with phase_timer("conv.up_rewrite"):
+                        audit = audit_up(AGENT2_CONF, up_intervals)
+                        eliminated = apply_up_rewrite(audit, AGENT2_CONF)
+                    logging.info("UserParameter forks per minute: {!s}, eliminated: {!s}, more by proposals: {!s}".format(
+                        audit["forks_per_min"], eliminated, audit["propose_forks_per_min"]))
+                    emit_event("up_rewrite", forks_per_min=audit["forks_per_min"], eliminated=eliminated,
+                        proposed=audit["propose_forks_per_min"])
+                checkpoint.done("conv", fingerprint, agent2_conf_sha256=file_sha256(AGENT2_CONF), snapshot=snapshot,
+                    snapshot_after=snapshot_fingerprint("", CHECKPOINT_AGENT2_CONF, ignore_not_support_params, capacity_mode))
+        # 5. systemctl stop zabbix-agent 或 service zabbix-agent stop。（这里最好 rhel7 的才升级）
+        # systemctl disable zabbix-agent
+        # systemctl start zabbix-agent2
+        # systemctl enable zabbix-agent2
+        # systemctl status zabbix-agent2
+        # 切换前 agentd 依然在运行时，保存其返回值和延迟作为基准
+        if parity_check and checkpoint.get("enable", fingerprint) is None and service_is_active("zabbix-agent"):
+            with phase_timer("parity.before"):
+                parity_save_baseline(AGENTD_CONF, parity_extra_keys)
+        with phase_timer("enable"):
+            # 端口可能仍由 agentd 应答，需同时确认切换后的服务状态
+            if not checkpoint.skip("enable", fingerprint,
+                    lambda rec: service_is_active("zabbix-agent2") and not service_is_active("zabbix-agent") and
+                        wait_agent_ready(*get_agent_listen(AGENT2_CONF), timeout=3) is not None):
+                journal_services(["zabbix-agent", "zabbix-agent2"])
+                if fast_cutover:
+                    if cutover_agent2(AGENT2_CONF) is None:
+                        raise Exception("cutover agent2 is failed")
+                elif not conv_agent2_enable():
+                    raise Exception("conv agent2 systemd is failed")
+                checkpoint.done("enable", fingerprint)
+        if parity_check:
+            with phase_timer("parity.after"):
+                report = parity_check_agent2(AGENT2_CONF)
+            if report and report["regressions"]:
+                info_echo("parity", "regressions: {!s}".format(", ".join(report["regressions"])))
+
+class InotifyWatcher(object):
+    """通过 ctypes 调用 libc 的 inotify 监听目录中文件的变化。
+
+    监听的是文件所在的目录，配置管理工具以 rename 替换文件时同样能收到事件。
+    """
+    IN_MODIFY = 0x00000002
+    IN_ATTRIB = 0x00000004
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    rescan_interval = SYNC_RESCAN_INTERVAL
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 is failed")
+        self.watches = {}
+
+    def watch(self, path):
+        if path in self.watches or not os.path.isdir(path):
+            return
+        wd = self._libc.inotify_add_watch(self.fd, path, self.MASK)
+        if wd < 0:
+            logging.warning("cannot watch {!s}, errno: {!s}".format(path, ctypes.get_errno()))
+            return
+        logging.debug("watch {!s}".format(path))
+        self.watches[path] = wd
+
+    def wait(self, timeout):
+        """等待事件并读空事件队列，收到事件返回 True，超时或被信号打断返回 False。
+        """
+        try:
+            readable, _, _ = select.select([self.fd], [], [], timeout)
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return False
+            raise
+        if not readable:
+            return False
+        while True:
+            try:
+                if not os.read(self.fd, 65536):
+                    break
+            except OSError as e:
+                if e.errno == errno.EAGAIN:
+                    break
+                raise
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+class PollWatcher(object):
+    """没有 inotify 时的退化方式，按 SYNC_POLL_INTERVAL 唤醒，由调用方比较文件的状态。
+    """
+    rescan_interval = SYNC_POLL_INTERVAL
+
+    def watch(self, path):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return False
+
+    def close(self):
+        pass
+
+def sync_snapshot(agentd_conf_path, prev=None):
+    """获取 agentd 配置及其所有 Include 文件（含嵌套）的状态。
+
+    Include 文件由 scan_include_up 展开，未变的文件复用扫描结果；stat 未变的文件沿用 prev 中的 sha256，
+    只有 stat 变化的文件才重新计算，以内容判断文件是否真的改变。
+
+    Args:
+        agentd_conf_path: agentd 的配置文件路径。
+        prev: 可选，上次的状态。
+    Returns:
+        <dict>: {<path>: [<inode>, <mtime>, <size>, <sha256>]}
+    """
+    prev = prev or {}
+    paths = [agentd_conf_path]
+    if os.path.isfile(agentd_conf_path):
+        include_res, _ = scan_include_up(load_zbx_conf(agentd_conf_path).get_all("Include"))
+        paths.extend(sorted(include_res))
+    res = {}
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        st = os.stat(path)
+        stat_key = [st.st_ino, st.st_mtime, st.st_size]
+        old = prev.get(path)
+        res[path] = stat_key + [old[3] if old and old[:3] == stat_key else file_sha256(path)]
+    return res
+
+def sync_watch_dirs(agentd_conf_path, files):
+    """需要监听的目录：配置文件和 Include 文件所在的目录，以及 Include 指向的目录，以发现新增的文件。
+    """
+    res = set(os.path.dirname(i) for i in files)
+    res.add(os.path.dirname(os.path.abspath(agentd_conf_path)))
+    if os.path.isfile(agentd_conf_path):
+        for pattern in load_zbx_conf(agentd_conf_path).get_all("Include"):
+            res.add(pattern if os.path.isdir(pattern) else os.path.dirname(pattern))
+    return sorted(res)
+
+def sync_main_conf(agentd_conf_path, agent2_conf_path, state, deal_with_up=False, capacity_mode=PLUGIN_CAPACITY_MODE):
+    """agentd 主配置变化时，以 diff_zbx_conf 重新对比，只将更新、新增和删除的项改写到 agent2 的配置。
+
+    已在 agent2 中被注释掉的 UserParameter（冲突或已改写为 Alias）不再加回。
+
+    Returns:
+        <bool>: agent2 的配置是否被改写。
+    """
+    agentd_conf = load_zbx_conf(agentd_conf_path)
+    agent2_conf = load_zbx_conf(agent2_conf_path)
+    current = [(k, v) for k, values in agentd_conf.index.items() for v in values]
+    previous = set(tuple(i) for i in state.get("items") or current)
+    # 单值的项只在 agentd 中不再出现时删除，值的变化由 update_items 处理
+    remove_items = [i for i in previous - set(current) if i[0] not in CONF_AGENT2_NOTSUPPORT_PARAMS and
+        (i[0] in CONF_MULTI_VALUE_ITEMS or i[0] not in agentd_conf.index)]
+
+    diff = diff_zbx_conf(agentd_conf, agent2_conf, True)
+    merge_plugin_capacity(diff, agentd_conf_path, agent2_conf, capacity_mode)
+    with open(agent2_conf_path, "r") as f:
+        line_list = f.readlines()
+    disabled = set()
+    for line in line_list:
+        for prefix in (CONFLICT_LINE_PREFIX, UP_REWRITE_LINE_PREFIX):
+            if line.startswith(prefix):
+                item = tokenize_zbx_line(line[len(prefix):])
+                if item and item[0] == "UserParameter":
+                    disabled.add(item[1])
+    add_items = [i for i in diff.add_items if not (i[0] == "UserParameter" and i[1] in disabled)]
+
+    changed = False
+    new_line_list = rewrite_conf_lines(line_list, diff.update_items, add_items, CONF_IGNORE_ITEM, remove_items,
+        diff.ordered_items)
+    if new_line_list != line_list:
+        journal_write_file(agent2_conf_path, "".join(new_line_list))
+        changed = True
+
+    self_key = "@{!s}".format(agent2_conf_path)
+    conflict_dict, _ = check_conflict_up(agent2_conf_path)
+    if self_key in conflict_dict:
+        if not deal_with_up:
+            raise Exception("found conflict UserParameter in {!s}: {!s}".format(
+                agent2_conf_path, ", ".join(conflict_dict[self_key])))
+        deal_conflict_up({self_key: conflict_dict[self_key]})
+        changed = True
+    state["items"] = current
+    return changed
+
+def sync_agent2_once(agentd_conf_path, agent2_conf_path, state, deal_with_up=False, capacity_mode=PLUGIN_CAPACITY_MODE):
+    """比较 agentd 配置及 Include 文件与上次同步时的状态，只处理内容有变化的文件。
+
+    主配置变化时增量改写 agent2 的配置；Include 文件由 agent2 直接引用，变化时检查其中新的冲突
+    UserParameter，并标记 agent2 需要重启。
+
+    Args:
+        agentd_conf_path: agentd 的配置文件路径。
+        agent2_conf_path: agent2 的配置文件路径。
+        state: 上次同步的状态，会被更新，state["restart"] 标记 agent2 需要重启。
+        deal_with_up: 是否注释掉冲突的 UserParameter，否则发现冲突时抛出异常。
+        capacity_mode: StartAgents 转换为插件 Capacity 的方式。
+    Returns:
+        <list>: 内容有变化的文件。
+    """
+    prev_files = state.get("files") or {}
+    files = sync_snapshot(agentd_conf_path, prev_files)
+    changed = sorted(i for i in set(files) | set(prev_files)
+        if (files.get(i) or [None] * 4)[3] != (prev_files.get(i) or [None] * 4)[3])
+    if not changed:
+        state["files"] = files
+        return changed
+    logging.info("changed files: {!s}".format(", ".join(changed)))
+
+    if agentd_conf_path in changed and sync_main_conf(agentd_conf_path, agent2_conf_path, state, deal_with_up, capacity_mode):
+        state["restart"] = True
+
+    includes = [i for i in changed if i != agentd_conf_path]
+    if includes:
+        include_res, _ = scan_include_up([i for i in includes if i in files])
+        conflict_dict = CONFLICT_UP_MATCHER.report(include_res)
+        if conflict_dict:
+            if not deal_with_up:
+                raise Exception("found conflict UserParameter in {!s}".format(", ".join(sorted(conflict_dict))))
+            deal_conflict_up(conflict_dict)
+            state["restart"] = True
+        # 首次同步时没有上次的状态，视为运行中的 agent2 已加载当前的 Include 文件
+        elif prev_files:
+            state["restart"] = True
+
+    # 本次改写的文件不应在下次被视为变化
+    state["files"] = sync_snapshot(agentd_conf_path, files)
+    return changed
+
+def reload_agent2(agent2_conf_path=AGENT2_CONF):
+    """agent2 不支持重新加载配置，校验配置后重启服务并等待其就绪，校验失败时不触碰运行中的 agent2。
+    """
+    if not validate_agent2_conf(agent2_conf_path):
+        raise Exception("the agent2 config {!s} is invalid, keep the running zabbix-agent2".format(agent2_conf_path))
+    if not systemctl_action("restart", "zabbix-agent2"):
+        raise Exception("systemctl restart zabbix-agent2 is failed")
+    if wait_agent_ready(*get_agent_listen(agent2_conf_path)) is None:
+        raise Exception("zabbix-agent2 is not ready after restart")
+
+def sync_daemon(agentd_conf_path=AGENTD_CONF, agent2_conf_path=AGENT2_CONF, deal_with_up=False,
+        capacity_mode=PLUGIN_CAPACITY_MODE, state_path=SYNC_STATE_PATH, once=False):
+    """常驻运行，将 agentd 配置及 Include 文件的改动增量同步到 agent2，只在 agent2 的配置或其引用的文件
+    确实改变时重启 agent2。
+
+    优先使用 inotify 监听，收到事件后等待 SYNC_DEBOUNCE 秒合并连续的改动，并每 SYNC_RESCAN_INTERVAL 秒
+    全量检查一次；没有 inotify 时每 SYNC_POLL_INTERVAL 秒比较一次文件的状态。升级的改动日志存在时，
+    改动同样记录于其中，回滚时一并恢复。
+
+    Args:
+        agentd_conf_path: agentd 的配置文件路径。
+        agent2_conf_path: agent2 的配置文件路径。
+        deal_with_up: 是否注释掉冲突的 UserParameter。
+        capacity_mode: StartAgents 转换为插件 Capacity 的方式。
+        state_path: 状态文件路径。
+        once: 只同步一次后退出。
+    """
+    if os.path.isfile(JOURNAL_PATH):
+        init_journal()
+    state = {}
+    if os.path.isfile(state_path):
+        with open(state_path, "r") as f:
+            state = json.load(f)
+    if once:
+        watcher = PollWatcher()
+    else:
+        try:
+            watcher = InotifyWatcher()
+        except (OSError, AttributeError) as e:
+            logging.warning("inotify is not available ({!s}), fall back to polling".format(e))
+            watcher = PollWatcher()
+
+    stopping = []
+    def stop(signum, frame):
+        logging.info("receive signal {!s}, stop syncing".format(signum))
+        stopping.append(signum)
+    if not once:
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, stop)
+
+    try:
+        while not stopping:
+            start = time.time()
+            changed = []
+            error = None
+            try:
+                changed = sync_agent2_once(agentd_conf_path, agent2_conf_path, state, deal_with_up, capacity_mode)
+                if state.get("restart"):
+                    reload_agent2(agent2_conf_path)
+                    state["restart"] = False
+                    logging.info("zabbix-agent2 is restarted for the synced changes")
+            except Exception as e:
+                logging.exception(e)
+                error = str(e)
+            finally:
+                if not os.path.isdir(os.path.dirname(state_path)):
+                    os.makedirs(os.path.dirname(state_path))
+                atomic_write(state_path, json.dumps(state))
+            if changed or error:
+                emit_event("sync", changed=changed, restart_pending=bool(state.get("restart")),
+                    duration=round(time.time() - start, 6), ok=error is None, error=error)
+            if once:
+                if error:
+                    raise Exception(error)
+                break
+            for i in sync_watch_dirs(agentd_conf_path, state.get("files") or {}):
+                watcher.watch(i)
+            if watcher.wait(watcher.rescan_interval) and not stopping:
+                time.sleep(SYNC_DEBOUNCE)
+    finally:
+        watcher.close()
+
+class CommandTransport(object):
+    """fleet 模式的传输方式，将带有 INPUT_* 参数的脚本通过 stdin 交给目标主机上的 python 执行。
+
+    Args:
+        command_template: 命令列表，其中的 {host} 会被替换为目标主机。
+        timeout: 单台主机的超时秒数。
+    """
+    def __init__(self, command_template, timeout=FLEET_HOST_TIMEOUT):
+        self.command_template = command_template
+        self.timeout = timeout
+
+    def command(self, host):
+        return [i.format(host=host) for i in self.command_template]
+
+    def run(self, host, payload):
+        """在目标主机上执行脚本。
+
+        Returns:
+            <int>: 退出码，超时返回 None。
+            <list>: 输出的所有行。
+        """
+        res = run_command(
+            self.command(host),
+            timeout=self.timeout,
+            input_data=payload,
+            log_level=logging.DEBUG,
+            log_prefix="[{!s}] ".format(host),
+            tail=None,
+        )
+        lines = res.output
+        if res.timed_out:
+            lines.append("killed after {!s} seconds".format(self.timeout))
+        return res.returncode, lines
+
+def load_fleet_hosts(hosts):
+    """读取 fleet 的主机列表。
+
+    Args:
+        hosts: 主机列表文件路径，或逗号/换行分隔的字符串，或列表。
+    Returns:
+        <list>: 去重并保持顺序的主机列表。
+    """
+    if isinstance(hosts, (list, tuple)):
+        lst = list(hosts)
+    elif os.path.isfile(hosts):
+        with open(hosts, "r") as f:
+            lst = [l.split("#")[0] for l in f]
+    else:
+        lst = hosts.replace(",", "\n").split("\n")
+    res = []
+    for i in lst:
+        i = i.strip()
+        if i and i not in res:
+            res.append(i)
+    return res
+
+def build_fleet_payload(params):
+    """生成下发到目标主机的脚本内容，与自动化平台一样以 INPUT_* 变量前置的方式传参。
+    """
+    with open(os.path.abspath(__file__), "r") as f:
+        source = f.read()
+    # 去掉自动化平台前置于本脚本的 INPUT_* 变量，避免覆盖下发的参数。
+    source = re.sub(r"(?m)^INPUT_\w+\s*=.*$", "", source)
+    header = ["# -*- coding: utf-8 -*-"]
+    for k in sorted(params):
+        header.append("{!s} = {!r}".format(k, params[k]))
+    return "\n".join(header) + "\n" + source
+
+def load_fleet_state(state_path):
+    """读取 fleet 的状态文件，每行为一台主机的一条记录，同一主机以最后一条为准。
+
+    Args:
+        state_path: 状态文件路径。
+    Returns:
+        <dict>: {<host>: <record>}
+    """
+    if not state_path or not os.path.isfile(state_path):
+        return {}
+    state = {}
+    with open(state_path, "r") as f:
+        for i, line in enumerate(f):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # 中断时最后一行可能不完整
+                logging.warning("fleet state {!s} line {!s} is broken, ignore it".format(state_path, i + 1))
+                continue
+            state[record["host"]] = record
+    return state
+
+def save_fleet_state(state_path, state):
+    """将 fleet 的状态整理为每台主机一行，写入临时文件后替换状态文件。
+    """
+    if not state_path:
+        return
+    tmp_path = state_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for host in sorted(state):
+            f.write(json.dumps(state[host], sort_keys=True) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, state_path)
+
+def append_fleet_state(f, record):
+    """追加一台主机的记录到状态文件，避免每次都重写整个文件。
+
+    Args:
+        f: 以追加方式打开的状态文件，为 None 则不记录。
+        record: 主机的记录。
+    """
+    if f is None:
+        return
+    f.write(json.dumps(record, sort_keys=True) + "\n")
+    f.flush()
+    os.fsync(f.fileno())
+
+def fleet_execute(hosts, transport, params, workers=FLEET_WORKERS, state_path=FLEET_STATE_PATH):
+    """对多台主机并发执行 execute() 的升级流程。
+
+    每台主机的状态记录于 state_path，中断后再次执行时，以相同任务（见 FLEET_TASK_PARAMS）
+    已成功的主机会被跳过，其余（包括中断时正在执行的）主机会重新执行。
+
+    Args:
+        hosts: 主机列表。
+        transport: 传输方式，需实现 run(host, payload) -> (returncode, output_lines)。
+        params: 传给目标主机的 INPUT_* 参数。
+        workers: 并发数。
+        state_path: 状态文件路径，为空则不记录。
+    Returns:
+        <dict>: {<host>: <record>}
+    """
+    payload = build_fleet_payload(params)
+    state = load_fleet_state(state_path)
+    lock = threading.Lock()
+    stop_event = threading.Event()
+    queue = Queue()
+
+    task = dict((k, params.get(k)) for k in FLEET_TASK_PARAMS)
+    for host in hosts:
+        record = state.setdefault(host, {"host": host, "attempts": 0})
+        if record.get("state") == "success" and record.get("task") == task:
+            logging.info("fleet host {!s} has been done with the same task, skip it".format(host))
+            continue
+        record["state"] = "pending"
+        record["task"] = task
+        queue.put(host)
+    save_fleet_state(state_path, state)
+    state_file = open(state_path, "a") if state_path else None
+
+    def worker():
+        while not stop_event.is_set():
+            try:
+                host = queue.get_nowait()
+            except Empty:
+                return
+            with lock:
+                record = state[host]
+                record["state"] = "running"
+                record["attempts"] += 1
+                record["start_time"] = time.time()
+                append_fleet_state(state_file, record)
+            logging.info("fleet host {!s} is upgrading ......".format(host))
+            try:
+                returncode, lines = transport.run(host, payload)
+            except Exception as e:
+                returncode, lines = None, [str(e)]
+            # 目标主机的事件流混在输出中，转写到本机的事件流，其余的输出保留最后几行
+            tail = deque(maxlen=FLEET_OUTPUT_TAIL)
+            for line in lines:
+                if line.startswith('{"') and '"event": ' in line:
+                    write_event_line(line)
+                else:
+                    tail.append(line)
+            tail = list(tail)
+            with lock:
+                record["end_time"] = time.time()
+                record["duration"] = round(record["end_time"] - record["start_time"], 3)
+                record["returncode"] = returncode
+                record["output_tail"] = tail
+                for line in tail:
+                    m = re.match(r"^monitoring gap: ([0-9.]+)s$", line.strip())
+                    if m:
+                        record["monitoring_gap"] = float(m.group(1))
+                record["state"] = "success" if returncode == 0 else "failed"
+                append_fleet_state(state_file, record)
+            if returncode == 0:
+                logging.info("fleet host {!s} is upgraded successfully".format(host))
+            else:
+                logging.error("fleet host {!s} upgrading is failed, returncode: {!s}".format(host, returncode))
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, int(workers)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        while any(t.is_alive() for t in threads):
+            for t in threads:
+                t.join(0.5)
+    except KeyboardInterrupt:
+        logging.warning("fleet is interrupted, waiting for the running hosts ......")
+        stop_event.set()
+        raise
+    finally:
+        if state_file is not None:
+            with lock:
+                state_file.close()
+                state_file = None
+
+    summary = {}
+    for host in hosts:
+        summary.setdefault(state[host]["state"], []).append(host)
+    info_echo("fleet", "\n".join("{!s}: {!s}".format(k, len(v)) for k, v in sorted(summary.items())))
+    return dict((host, state[host]) for host in hosts)
 
 
 if __name__ == "__main__":
@@ -564,20 +3123,141 @@ if __name__ == "__main__":
     init_logger("debug")
 
     # input args deal
-    INPUT_CAN_REMOVE = True if str(INPUT_CAN_REMOVE).lower() == "true" else False
-    INPUT_IGNORE_NOT_SUPPORT_PARAMS = True if str(INPUT_IGNORE_NOT_SUPPORT_PARAMS).lower() == "true" else False
-    INPUT_DEAL_CONFLICT_UP = True if str(INPUT_DEAL_CONFLICT_UP).lower() == "true" else False
-    INPUT_ROLLBACK = True if str(INPUT_ROLLBACK).lower() == "true" else False
+    INPUT_AGENT2_RPM_URL = globals().get("INPUT_AGENT2_RPM_URL")
+    INPUT_CAN_REMOVE = True if str(globals().get("INPUT_CAN_REMOVE")).lower() == "true" else False
+    INPUT_IGNORE_NOT_SUPPORT_PARAMS = True if str(globals().get("INPUT_IGNORE_NOT_SUPPORT_PARAMS")).lower() == "true" else False
+    INPUT_DEAL_CONFLICT_UP = True if str(globals().get("INPUT_DEAL_CONFLICT_UP")).lower() == "true" else False
+    INPUT_ROLLBACK = True if str(globals().get("INPUT_ROLLBACK")).lower() == "true" else False
+    INPUT_FAST_CUTOVER = True if str(globals().get("INPUT_FAST_CUTOVER")).lower() == "true" else False
+    INPUT_MODE = str(globals().get("INPUT_MODE") or "upgrade").lower()
+    INPUT_PLUGIN_CAPACITY = str(globals().get("INPUT_PLUGIN_CAPACITY") or PLUGIN_CAPACITY_MODE).lower()
+    INPUT_UP_REWRITE = True if str(globals().get("INPUT_UP_REWRITE")).lower() == "true" else False
+    INPUT_PARITY_CHECK = True if str(globals().get("INPUT_PARITY_CHECK")).lower() == "true" else False
+    INPUT_PARITY_KEYS = [i for i in str(globals().get("INPUT_PARITY_KEYS") or "").split(",") if i.strip()]
+    INPUT_EVENT_LOG = globals().get("INPUT_EVENT_LOG")
     # EOF input args deal
 
+    # 未知的模式（如拼写错误）不能落入升级
+    if INPUT_MODE not in RUN_MODES:
+        logging.error("unknown mode: {!s}, must be one of {!s}".format(INPUT_MODE, ", ".join(RUN_MODES)))
+        exit(1)
+    remote_mode = str(globals().get("INPUT_FLEET_REMOTE_MODE") or "upgrade").lower()
+    if INPUT_MODE == "fleet" and remote_mode not in FLEET_REMOTE_MODES:
+        logging.error("unknown fleet_remote_mode: {!s}, must be one of {!s}".format(remote_mode, ", ".join(FLEET_REMOTE_MODES)))
+        exit(1)
+
+    init_event_stream(INPUT_EVENT_LOG)
     try:
-        execute(
-            url = INPUT_AGENT2_RPM_URL,
-            can_remove = INPUT_CAN_REMOVE,
-            ignore_not_support_params = INPUT_IGNORE_NOT_SUPPORT_PARAMS,
-            deal_with_up = INPUT_DEAL_CONFLICT_UP,
-            exec_rollback = INPUT_ROLLBACK,
-        )
+        up_intervals = globals().get("INPUT_UP_INTERVALS")
+        if up_intervals and not isinstance(up_intervals, dict):
+            with open(up_intervals, "r") as f:
+                up_intervals = json.load(f)
+
+        if INPUT_MODE == "report":
+            info_echo("report", json.dumps(
+                aggregate_events(str(INPUT_EVENT_FILES).split(",")),
+                indent=2,
+            ))
+        elif INPUT_MODE == "plan":
+            plan = plan_upgrade(
+                AGENTD_CONF,
+                globals().get("INPUT_AGENT2_TEMPLATE") or INPUT_AGENT2_RPM_URL,
+                INPUT_IGNORE_NOT_SUPPORT_PARAMS,
+                globals().get("INPUT_AGENT2_RPM_SHA256"),
+                INPUT_PLUGIN_CAPACITY,
+            )
+            emit_event("plan", plan=plan)
+            if globals().get("INPUT_PLAN_OUTPUT"):
+                with open(INPUT_PLAN_OUTPUT, "w") as f:
+                    json.dump(plan, f, indent=2)
+            else:
+                info_echo("plan", json.dumps(plan, indent=2))
+        elif INPUT_MODE == "audit":
+            audit = audit_up(AGENTD_CONF if os.path.isfile(AGENTD_CONF) else AGENT2_CONF, up_intervals)
+            emit_event("up_audit", **dict((k, v) for k, v in audit.items() if k != "items"))
+            info_echo("audit", json.dumps(audit, indent=2))
+        elif INPUT_MODE == "parity":
+            def parse_listen(listen, conf_path):
+                if not listen:
+                    return get_agent_listen(conf_path)
+                host, port = listen.rsplit(":", 1)
+                return host, int(port)
+            report = parity_agents(
+                parse_listen(globals().get("INPUT_PARITY_BEFORE"), AGENTD_CONF),
+                parse_listen(globals().get("INPUT_PARITY_AFTER"), AGENT2_CONF),
+                parity_keys(AGENTD_CONF, INPUT_PARITY_KEYS),
+            )
+            info_echo("parity", json.dumps(report, indent=2))
+            if report["regressions"]:
+                raise Exception("found parity regressions: {!s}".format(", ".join(report["regressions"])))
+        elif INPUT_MODE == "sync":
+            sync_daemon(
+                deal_with_up = INPUT_DEAL_CONFLICT_UP,
+                capacity_mode = INPUT_PLUGIN_CAPACITY,
+                once = str(globals().get("INPUT_SYNC_ONCE")).lower() == "true",
+            )
+        elif INPUT_MODE == "bulk":
+            template = globals().get("INPUT_AGENT2_TEMPLATE") or INPUT_AGENT2_RPM_URL
+            if template.endswith(".rpm") or "://" in template:
+                if not os.path.isdir(INPUT_BULK_OUTPUT):
+                    os.makedirs(INPUT_BULK_OUTPUT)
+                template_path = os.path.join(INPUT_BULK_OUTPUT, ".template.conf")
+                with open(template_path, "w") as f:
+                    f.write(extract_rpm_file(fetch_rpm(template, globals().get("INPUT_AGENT2_RPM_SHA256")), AGENT2_CONF))
+                template = template_path
+            summary = bulk_convert(
+                INPUT_BULK_STORE,
+                template,
+                INPUT_BULK_OUTPUT,
+                INPUT_IGNORE_NOT_SUPPORT_PARAMS,
+                int(globals().get("INPUT_BULK_WORKERS") or 0) or None,
+                INPUT_PLUGIN_CAPACITY,
+            )
+            if any("error" in i for i in summary.values()):
+                raise Exception("some snapshots are failed to convert, please check the summary")
+        elif INPUT_MODE == "fleet":
+            records = fleet_execute(
+                hosts = load_fleet_hosts(INPUT_FLEET_HOSTS),
+                transport = CommandTransport(FLEET_TRANSPORTS[globals().get("INPUT_FLEET_TRANSPORT", "ssh")]),
+                params = {
+                    "INPUT_AGENT2_RPM_URL": INPUT_AGENT2_RPM_URL,
+                    "INPUT_CAN_REMOVE": INPUT_CAN_REMOVE,
+                    "INPUT_IGNORE_NOT_SUPPORT_PARAMS": INPUT_IGNORE_NOT_SUPPORT_PARAMS,
+                    "INPUT_DEAL_CONFLICT_UP": INPUT_DEAL_CONFLICT_UP,
+                    "INPUT_ROLLBACK": INPUT_ROLLBACK,
+                    "INPUT_AGENT2_RPM_SHA256": globals().get("INPUT_AGENT2_RPM_SHA256"),
+                    "INPUT_FAST_CUTOVER": INPUT_FAST_CUTOVER,
+                    "INPUT_PLUGIN_CAPACITY": INPUT_PLUGIN_CAPACITY,
+                    "INPUT_UP_REWRITE": INPUT_UP_REWRITE,
+                    "INPUT_UP_INTERVALS": up_intervals,
+                    "INPUT_PARITY_CHECK": INPUT_PARITY_CHECK,
+                    "INPUT_PARITY_KEYS": ",".join(INPUT_PARITY_KEYS),
+                    "INPUT_PARITY_BEFORE": globals().get("INPUT_PARITY_BEFORE"),
+                    "INPUT_PARITY_AFTER": globals().get("INPUT_PARITY_AFTER"),
+                    "INPUT_AGENT2_TEMPLATE": globals().get("INPUT_AGENT2_TEMPLATE"),
+                    "INPUT_MODE": remote_mode,
+                    "INPUT_EVENT_LOG": "-" if INPUT_EVENT_LOG else None,
+                },
+                workers = globals().get("INPUT_FLEET_WORKERS", FLEET_WORKERS),
+                state_path = globals().get("INPUT_FLEET_STATE", FLEET_STATE_PATH),
+            )
+            if any(r["state"] != "success" for r in records.values()):
+                raise Exception("some hosts of the fleet are failed, please check the fleet state")
+        elif INPUT_MODE == "upgrade":
+            execute(
+                url = INPUT_AGENT2_RPM_URL,
+                can_remove = INPUT_CAN_REMOVE,
+                ignore_not_support_params = INPUT_IGNORE_NOT_SUPPORT_PARAMS,
+                deal_with_up = INPUT_DEAL_CONFLICT_UP,
+                exec_rollback = INPUT_ROLLBACK,
+                rpm_sha256 = globals().get("INPUT_AGENT2_RPM_SHA256"),
+                fast_cutover = INPUT_FAST_CUTOVER,
+                capacity_mode = INPUT_PLUGIN_CAPACITY,
+                up_rewrite = INPUT_UP_REWRITE,
+                up_intervals = up_intervals,
+                parity_check = INPUT_PARITY_CHECK,
+                parity_extra_keys = INPUT_PARITY_KEYS,
+            )
     except Exception as e:
         logging.exception(e)
         exit(1)